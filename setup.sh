@@ -322,17 +322,38 @@ cat <<EOL > "$PARAMS_FILE"
 ext: '$EXT_PATH'
 conda_prefix: '$DEFAULT_CONDA_ENV_DIR'
 
+# --- retention --- #
+retention: 'all' # 'all' keeps the tools' intermediate files, 'reports' only keeps the reports the workflow reads, 'compress' gzips the rest
+
+# --- result cache --- #
+result_cache: ''
+result_cache_tag: ''
 
 # --- checkm --- #
 checkm2_db: '$CHECKM2_DB'
 checkm1_db: '$CHECKM1_DB'
 
+# --- coverage --- #
+cov_min_align: 0.98
+cov_max_edit_dist: 0.02
+cov_all_reads: False # True also counts paired reads that aren't mapped in a proper pair (checkm coverage -a)
+
 # --- gunc --- #
 diamond_db: '$DIAMOND_DB'
 
 # --- gtdbtk --- #
 gtdb_db: '$GTDB_DB'
 
+# --- dnadiff --- #
+ref_store: ''
+ref_store_max_gb: 100
+batch_align: False
+ani_screen: '' # '' aligns every MAG, 'screen' only aligns MAGs that pass the sketch-based ANI estimate, 'fast' never aligns
+ani_screen_min_ani: 95
+ani_screen_min_af: 30
+sketch_k: 21
+sketch_scaled: 200
+
 # --- quast --- #
 min_contig_len: $TEST_MIN_CONTIG_LEN
 EOL
@@ -348,17 +369,38 @@ cat <<EOL > "$PARAMS_FILE"
 ext: '$EXT_PATH'
 conda_prefix: '$DEFAULT_CONDA_ENV_DIR'
 
+# --- retention --- #
+retention: 'all' # 'all' keeps the tools' intermediate files, 'reports' only keeps the reports the workflow reads, 'compress' gzips the rest
+
+# --- result cache --- #
+result_cache: ''
+result_cache_tag: ''
 
 # --- checkm --- #
 checkm2_db: '$CHECKM2_DB'
 checkm1_db: '$CHECKM1_DB'
 
+# --- coverage --- #
+cov_min_align: 0.98
+cov_max_edit_dist: 0.02
+cov_all_reads: False # True also counts paired reads that aren't mapped in a proper pair (checkm coverage -a)
+
 # --- gunc --- #
 diamond_db: '$DIAMOND_DB'
 
 # --- gtdbtk --- #
 gtdb_db: '$GTDB_DB'
 
+# --- dnadiff --- #
+ref_store: ''
+ref_store_max_gb: 100
+batch_align: False
+ani_screen: '' # '' aligns every MAG, 'screen' only aligns MAGs that pass the sketch-based ANI estimate, 'fast' never aligns
+ani_screen_min_ani: 95
+ani_screen_min_af: 30
+sketch_k: 21
+sketch_scaled: 200
+
 # --- quast --- #
 min_contig_len: $REAL_MIN_CONTIG_LEN
 EOL
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""bench_dag.py
+Time how long Snakemake takes to parse the workflow and build its DAG (as a dry run) for synthetic cohorts of
+increasing numbers of samples and MAGs per sample. The first run of each cohort includes ingestion; the second
+starts from the cached sample manifest, as every later invocation (and cluster job) does.
+"""
+
+
+import argparse
+from os import makedirs
+from os.path import abspath, dirname, join
+import subprocess
+import sys
+import tempfile
+import time
+
+
+MAIN_DIR = dirname(dirname(dirname(dirname(abspath(__file__))))) # /path/to/main_dir/workflow/ext/scripts/bench_dag.py
+
+
+def make_cohort(out_dir, num_samples, num_bins):
+    '''Write a samples.csv of num_samples samples that all share one directory of num_bins tiny MAGs.'''
+    mag_dir = join(out_dir, 'mags')
+    makedirs(mag_dir)
+    for b in range(num_bins):
+        with open(join(mag_dir, 'bin.{}.fa'.format(b)), 'w') as f_out:
+            f_out.write('>ctg_1\nACGTACGTAC\n')
+    open(join(out_dir, 'fake.bam'), 'w').close()
+    samples = join(out_dir, 'samples.csv')
+    with open(samples, 'w') as f_out:
+        f_out.write('sample_name,mag_dir,bam\n')
+        for s in range(num_samples):
+            f_out.write('s{},{},{}\n'.format(s, mag_dir, join(out_dir, 'fake.bam')))
+    return samples
+
+
+def time_dry_run(snakefile, work_dir, samples, configfiles):
+    cmd = [sys.executable, '-m', 'snakemake', '--snakefile', snakefile, '-n', '--quiet', '-c1', \
+        '--config', 'work_dir=' + work_dir, 'samples=' + samples, 'ext=' + join(dirname(snakefile), 'ext'), \
+        '--configfiles', *configfiles]
+    start = time.perf_counter()
+    subprocess.run(cmd, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, check = True, cwd = work_dir)
+    return time.perf_counter() - start
+
+
+def main(args):
+    configfiles = [join(MAIN_DIR, 'test_data', 'parameters.yaml'), join(MAIN_DIR, 'test_data', 'resources.yaml')]
+    print('num_samples\tnum_bins\tcold_s\twarm_s', flush = True)
+    for n in args.num_samples:
+        for b in args.num_bins:
+            with tempfile.TemporaryDirectory() as tmp:
+                samples = make_cohort(tmp, n, b)
+                work_dir = join(tmp, 'work')
+                makedirs(work_dir)
+                cold = time_dry_run(args.snakefile, work_dir, samples, configfiles)
+                warm = time_dry_run(args.snakefile, work_dir, samples, configfiles)
+            print('{}\t{}\t{:.2f}\t{:.2f}'.format(n, b, cold, warm), flush = True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num_samples", type=lambda x: [int(i) for i in x.split(',')], default=[1, 10, 50], \
+        help="Comma-separated numbers of samples.")
+    parser.add_argument("--num_bins", type=lambda x: [int(i) for i in x.split(',')], default=[10, 50], \
+        help="Comma-separated numbers of MAGs per sample.")
+    parser.add_argument("--snakefile", default=join(MAIN_DIR, 'workflow', 'Snakefile'), help="Snakefile to benchmark.")
+    args = parser.parse_args()
+    main(args)
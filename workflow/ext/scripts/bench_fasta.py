@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""bench_fasta.py
+Time the FastA toolkit in utils against the awk and line-by-line Python it replaced, on a synthetic co-assembly
+bin: header sanitisation for Prokka (ctg_name_edit), contig renaming (add_bin_num), and per-contig length and GC.
+"""
+
+
+import argparse
+from os.path import abspath, dirname, join
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+sys.path.insert(0, dirname(dirname(dirname(abspath(__file__))))) # /path/to/main_dir/workflow/ext/scripts/bench_fasta.py
+from utils import add_bin_num, contig_stats, sanitize_fasta
+
+
+AWK_SANITIZE = """
+if awk '/^>/ { if(length($0) > 37) exit 1 }' %(fi)s; then
+    ln -s %(fi)s %(fo)s
+else
+    awk '/^>/ { if(length($0) > 37) print substr($0, 1, 37); else print } !/^>/ { print }' %(fi)s > %(fo)s
+fi
+"""
+
+
+def make_bin(fo, mbp, ctg_len, long_headers):
+    '''Write a FastA of about mbp Mbp in contigs of about ctg_len bp, wrapped at 80 bp.'''
+    rng = random.Random(0)
+    block = ''.join(rng.choice('ACGT') for _ in range(1 << 16))
+    with open(fo, 'w') as f_out:
+        total, i = 0, 0
+        while total < mbp * 1e6:
+            n = rng.randint(ctg_len // 2, ctg_len * 3 // 2)
+            seq = (block * (n // len(block) + 1))[:n]
+            name = 'NODE_{}_length_{}_cov_12.345678_flag=1_multi=2.0000'.format(i, n) if long_headers else 'k141_{}'.format(i)
+            f_out.write('>' + name + '\n' + '\n'.join(seq[j:j + 80] for j in range(0, n, 80)) + '\n')
+            total += n
+            i += 1
+
+
+def old_add_bin_num(fi, bin_num, fo):
+    ctg_num = 0
+    with open(fi, 'r') as f_in, open(fo, 'w') as f_out:
+        for line in f_in:
+            if line[0] == '>':
+                f_out.write('>%s_%i\t%s\n' % (bin_num, ctg_num, line.strip('\n').replace('>', '')))
+                ctg_num += 1
+            else:
+                f_out.write(line)
+
+
+def old_contig_stats(fi):
+    stats = []
+    with open(fi, 'r') as f_in:
+        for line in f_in:
+            if line[0] == '>':
+                stats.append([line[1:].split()[0], 0, 0])
+            else:
+                s = line.strip()
+                stats[-1][1] += len(s)
+                stats[-1][2] += sum(1 for c in s if c in 'GCgc')
+    return stats
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main(args):
+    print('mbp\tlong_headers\tstep\told_s\tnew_s', flush = True)
+    for long_headers in [True, False]:
+        with tempfile.TemporaryDirectory() as tmp:
+            fi = join(tmp, 'bin.fa')
+            make_bin(fi, args.mbp, args.contig_len, long_headers)
+            sh = lambda: subprocess.run(AWK_SANITIZE % {'fi': fi, 'fo': join(tmp, 'awk.fa')}, shell = True, check = True)
+            steps = [
+                ('sanitize', sh, lambda: sanitize_fasta(fi, join(tmp, 'new.fa'))),
+                ('add_bin_num', lambda: old_add_bin_num(fi, '1', join(tmp, 'old_num.fa')), lambda: add_bin_num(fi, '1', join(tmp, 'new_num.fa'))),
+                ('contig_stats', lambda: old_contig_stats(fi), lambda: contig_stats(fi)),
+            ]
+            for step, old, new in steps:
+                print('{}\t{}\t{}\t{:.2f}\t{:.2f}'.format(args.mbp, long_headers, step, timed(old), timed(new)), flush = True)
+            # The outputs must match what they replaced
+            if open(join(tmp, 'awk.fa'), 'rb').read() != open(join(tmp, 'new.fa'), 'rb').read() or \
+                open(join(tmp, 'old_num.fa'), 'rb').read() != open(join(tmp, 'new_num.fa'), 'rb').read():
+                sys.exit('Outputs differ from the old implementation')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mbp", type=float, default=500, help="Size of the synthetic bin (Mbp).")
+    parser.add_argument("--contig_len", type=int, default=20000, help="Mean contig length (bp).")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+"""bench_suite.py
+Time the workflow's own overhead on synthetic cohorts, without the tools' databases: sample ingestion, building the
+DAG (as a dry run), the Python rules and summary scripts that run per MAG or per sample, and whole runs, with stub
+stand-ins for checkm2, checkm, gunc, gtdbtk, nucmer, dnadiff, quast.py, prokka and samtools that write reports with the
+real tools' layouts. Each measurement is appended to a JSON Lines file (one record per benchmark and cohort size, with
+the commit and host), so that runs can be compared over time.
+
+Whole runs are Snakemake runs with the same settings as `mag-qc.py run`, except without conda environments, since the
+stubs are on the PATH. The re-run benchmark also checks that after a MAG is added, replaced, or removed, a single run of
+the finished working directory leaves the same summaries as a fresh run does.
+"""
+
+
+import argparse
+import datetime
+import glob
+import gzip
+import json
+import os
+from os import makedirs
+from os.path import abspath, basename, dirname, exists, join
+import platform
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+
+MAIN_DIR = dirname(dirname(dirname(dirname(abspath(__file__))))) # /path/to/main_dir/workflow/ext/scripts/bench_suite.py
+SCRIPT_DIR = join(MAIN_DIR, 'workflow', 'ext', 'scripts')
+CTG_KBP = 10 # Synthetic contig length
+NUM_REFS = 20 # Synthetic reference genomes
+MAG_TAG = 32 # Random bases that make each synthetic MAG unique
+CLASSIFIED = 0.8 # Fraction of MAGs that the gtdbtk stub assigns a reference to
+FLAGS = {'--force', '--no-plots', '--tab_table', '--skip_ani_screen', '--maxmatch'} # Tool options without a value
+BGZF_BLOCK = 65280 # Uncompressed bytes per BGZF block (under 64 KB, as in htslib)
+STUBS = ['checkm2', 'checkm', 'gunc', 'gtdbtk', 'nucmer', 'dnadiff', 'quast.py', 'prokka', 'samtools']
+
+
+# --- Synthetic data --- #
+
+
+def random_seq(rng, n):
+    return ''.join(rng.choices('ACGT', k = n))
+
+
+def write_fasta(fo, ctgs, compress = False):
+    txt = ''.join('>{}\n{}\n'.format(name, seq) for name, seq in ctgs)
+    if compress:
+        with gzip.open(fo + '.gz', 'wt', compresslevel = 1) as f_out:
+            f_out.write(txt)
+    else:
+        with open(fo, 'w') as f_out:
+            f_out.write(txt)
+
+
+def bgzf_blocks(data):
+    '''BGZF-compress data (as in a BAM), ending with the empty EOF block.'''
+    out = []
+    for i in range(0, len(data), BGZF_BLOCK):
+        chunk = data[i:i + BGZF_BLOCK]
+        c = zlib.compressobj(6, zlib.DEFLATED, -15)
+        cdata = c.compress(chunk) + c.flush()
+        out.append(struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25) + cdata + \
+            struct.pack('<II', zlib.crc32(chunk), len(chunk)))
+    return b''.join(out) + bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def write_bam(fo, ctgs):
+    '''Header-only BAM (no reads) of reads mapped to the contigs, as (name, length).'''
+    hdr = b'BAM\x01' + struct.pack('<ii', 0, len(ctgs))
+    hdr += b''.join(struct.pack('<i', len(n) + 1) + n.encode() + b'\x00' + struct.pack('<i', l) for n, l in ctgs)
+    with open(fo, 'wb') as f_out:
+        f_out.write(bgzf_blocks(hdr))
+
+
+def make_refs(db_dir, seed = 0):
+    '''A GTDB-Tk database of NUM_REFS small reference genomes (skani/database/, laid out as in the real one).'''
+    rng = random.Random(seed)
+    accs = []
+    for r in range(NUM_REFS):
+        acc = 'GCF_{:09d}.1'.format(r + 1)
+        d = join(db_dir, 'skani', 'database', 'GCF', acc[4:7], acc[7:10], acc[10:13])
+        makedirs(d, exist_ok = True)
+        with gzip.open(join(d, acc + '_genomic.fna.gz'), 'wt', compresslevel = 1) as f_out:
+            f_out.write('>{}\n{}\n'.format(acc, random_seq(rng, 50000)))
+        accs.append(acc)
+    return accs
+
+
+def make_cohort(out_dir, num_samples, num_bins, mag_kbp, compress = False, seed = 0):
+    '''Write a samples.csv of num_samples samples of num_bins MAGs of mag_kbp kbp each, with their (read-less) BAMs.'''
+    rng = random.Random(seed)
+    makedirs(out_dir)
+    samples = join(out_dir, 'samples.csv')
+    with open(samples, 'w') as f_out:
+        f_out.write('sample_name,mag_dir,bam\n')
+        for s in range(num_samples):
+            mag_dir = join(out_dir, 'mags', 's{}'.format(s))
+            makedirs(mag_dir)
+            num_ctgs = max(1, mag_kbp // CTG_KBP)
+            # Contigs are shared between MAGs (only the ingest and the tools' stand-ins read them), but each MAG starts
+            # with its own tag, so that no two MAGs hit each other's entries in the result cache
+            ctgs = [random_seq(rng, mag_kbp * 1000 // num_ctgs) for _ in range(num_ctgs)]
+            bam_ctgs = []
+            for b in range(num_bins):
+                names = ['{}_{}'.format(b, i) for i in range(num_ctgs)]
+                tagged = [random_seq(rng, MAG_TAG) + ctgs[0][MAG_TAG:]] + ctgs[1:]
+                write_fasta(join(mag_dir, 'bin.{}.fa'.format(b)), list(zip(names, tagged)), compress)
+                bam_ctgs += [(n, len(c)) for n, c in zip(names, ctgs)]
+            write_bam(join(out_dir, 's{}.bam'.format(s)), bam_ctgs)
+            f_out.write('s{},{},{}\n'.format(s, mag_dir, join(out_dir, 's{}.bam'.format(s))))
+    return samples
+
+
+# --- Tool stand-ins --- #
+
+
+def parse_opts(argv):
+    '''Split a tool's arguments into {option: value} and positional arguments.'''
+    opts = {}
+    pos = []
+    i = 0
+    while i < len(argv):
+        a = argv[i]
+        if a.startswith('-') and a not in FLAGS and i + 1 < len(argv):
+            opts[a] = argv[i + 1]
+            i += 2
+        else:
+            if not a.startswith('-'):
+                pos.append(a)
+            i += 1
+    return opts, pos
+
+
+def fasta_stats(fi):
+    '''Number of contigs, length, GC content, and N50 of a FastA.'''
+    lens = []
+    gc = 0
+    with open(fi, 'r') as f_in:
+        for line in f_in:
+            if line[0] == '>':
+                lens.append(0)
+            else:
+                seq = line.strip()
+                lens[-1] += len(seq)
+                gc += seq.count('G') + seq.count('C')
+    size = sum(lens)
+    acc = 0
+    for n50 in sorted(lens, reverse = True):
+        acc += n50
+        if acc * 2 >= size:
+            break
+    return len(lens), size, (gc / size if size else 0), (n50 if lens else 0)
+
+
+def mag_rng(fi):
+    return random.Random(basename(fi))
+
+
+def mags_in(d, ext):
+    return sorted(glob.glob(join(d, '*.' + ext)))
+
+
+def stub_checkm2(argv):
+    opts, _ = parse_opts(argv[1:]) # predict
+    out = opts['--output-directory']
+    makedirs(join(out, 'protein_files'), exist_ok = True)
+    with open(join(out, 'quality_report.tsv'), 'w') as f_out:
+        f_out.write('Name\tCompleteness\tContamination\tCompleteness_Model_Used\tTranslation_Table_Used\tCoding_Density\t' \
+            'Contig_N50\tAverage_Gene_Length\tGenome_Size\tGC_Content\tTotal_Coding_Sequences\tAdditional_Notes\n')
+        for fi in mags_in(opts['--input'], opts.get('-x', 'fa')):
+            rng = mag_rng(fi)
+            _, size, gc, n50 = fasta_stats(fi)
+            f_out.write('{}\t{:.2f}\t{:.2f}\tNeural Network (Specific Model)\t11\t0.9\t{}\t300.0\t{}\t{:.2f}\t{}\tNone\n'.format( \
+                basename(fi)[:-3], rng.uniform(40, 100), rng.uniform(0, 12), n50, size, gc, size // 1000))
+            open(join(out, 'protein_files', basename(fi)[:-3] + '.faa'), 'w').close()
+
+
+def stub_checkm(argv):
+    if argv[0] != 'lineage_wf': # data setRoot
+        return
+    opts, pos = parse_opts(argv[1:])
+    makedirs(join(pos[1], 'storage'), exist_ok = True)
+    with open(opts['-f'], 'w') as f_out:
+        f_out.write('Bin Id\tMarker lineage\t# genomes\t# markers\t# marker sets\t0\t1\t2\t3\t4\t5+\tCompleteness\t' \
+            'Contamination\tStrain heterogeneity\n')
+        for fi in mags_in(pos[0], opts.get('-x', 'fa')):
+            rng = mag_rng(fi)
+            f_out.write('{}\tk__Bacteria (UID203)\t5449\t104\t58\t2\t100\t2\t0\t0\t0\t{:.2f}\t{:.2f}\t{:.2f}\n'.format( \
+                basename(fi)[:-3], rng.uniform(40, 100), rng.uniform(0, 12), rng.uniform(0, 100)))
+    open(join(pos[1], 'storage', 'bin_stats_ext.tsv'), 'w').close()
+
+
+def stub_gunc(argv):
+    opts, _ = parse_opts(argv[1:]) # run
+    out = opts['--out_dir']
+    makedirs(join(out, 'diamond_output'), exist_ok = True)
+    with open(join(out, 'GUNC.progenomes_2.1.maxCSS_level.tsv'), 'w') as f_out:
+        f_out.write('genome\tn_genes_called\tn_genes_mapped\tn_contigs\ttaxonomic_level\t' \
+            'proportion_genes_retained_in_major_clades\tgenes_retained_index\tclade_separation_score\tcontamination_portion\t' \
+            'n_effective_surplus_clades\tmean_hit_identity\treference_representation_score\tpass.GUNC\n')
+        for fi in mags_in(opts['--input_dir'], 'fa'):
+            rng = mag_rng(fi)
+            css = rng.uniform(0, 1)
+            f_out.write('{}\t2000\t1900\t{}\tkingdom\t1.0\t0.95\t{:.2f}\t0.01\t{:.2f}\t0.9\t0.9\t{}\n'.format(basename(fi)[:-3], \
+                fasta_stats(fi)[0], css, rng.uniform(0, 2), css < 0.45))
+            open(join(out, 'diamond_output', basename(fi)[:-3] + '.out'), 'w').close()
+
+
+def stub_gtdbtk(argv):
+    opts, _ = parse_opts(argv[1:]) # classify_wf
+    out = opts['--out_dir']
+    accs = [a for a in os.environ.get('BENCH_GTDB_REFS', '').split(',') if a]
+    makedirs(join(out, 'classify'), exist_ok = True)
+    with open(join(out, 'gtdbtk.bac120.summary.tsv'), 'w') as f_out:
+        f_out.write('user_genome\tclassification\tclosest_genome_reference\tclosest_genome_reference_radius\t' \
+            'closest_genome_taxonomy\tclosest_genome_ani\tclosest_genome_af\tclosest_placement_reference\t' \
+            'closest_placement_radius\tclosest_placement_taxonomy\tclosest_placement_ani\tclosest_placement_af\t' \
+            'pplacer_taxonomy\tclassification_method\tnote\tother_related_references(genome_id,species_name,radius,ANI,AF)\t' \
+            'msa_percent\ttranslation_table\tred_value\twarnings\n')
+        for fi in mags_in(opts['--genome_dir'], opts.get('-x', 'fa')):
+            rng = mag_rng(fi)
+            tax = 'd__Bacteria;p__Bacillota;c__Bacilli;o__Lactobacillales;f__Streptococcaceae;g__Streptococcus;s__'
+            if accs and rng.random() < CLASSIFIED:
+                acc = rng.choice(accs)
+                f_out.write('{}\t{}Streptococcus {}\t{}\t95.0\t{}\t98.5\t0.9\t{}\t95.0\t{}\t98.5\t0.9\t{}\t' \
+                    'taxonomic classification defined by topology and ANI\ttopological placement and ANI have congruent ' \
+                    'species assignments\tN/A\t90.0\t11\tN/A\tN/A\n'.format(basename(fi)[:-3], tax, acc, acc, tax, acc, tax, tax))
+            else:
+                f_out.write('{}\t{}\tN/A\tN/A\tN/A\tN/A\tN/A\tN/A\tN/A\tN/A\tN/A\tN/A\t{}\ttaxonomic novelty determined using RED' \
+                    '\tN/A\tN/A\t85.0\t11\t0.95\tN/A\n'.format(basename(fi)[:-3], tax, tax))
+
+
+def dnadiff_report(ref, qry, rng):
+    _, ref_len, _, _ = fasta_stats(ref)
+    n_ctgs, qry_len, _, _ = fasta_stats(qry)
+    ref_cov, qry_cov, ident = rng.uniform(20, 100), rng.uniform(50, 100), rng.uniform(95, 100)
+    return ('{ref} {qry}\nNUCMER\n\n                               [REF]                [QRY]\n[Sequences]\n' \
+        'TotalSeqs                          1 {n:>20}\nAlignedSeqs               1(100.00%) {n:>15}(100.00%)\n\n[Bases]\n' \
+        'TotalBases {rl:>24} {ql:>20}\nAlignedBases {ra:>15}({rc:.2f}%) {qa:>12}({qc:.2f}%)\n\n[Alignments]\n1-to-1\n' \
+        'AvgIdentity {i:>23.2f} {i:>20.2f}\n\nM-to-M\nAvgIdentity {i:>23.2f} {i:>20.2f}\n').format(ref = ref, qry = qry, n = n_ctgs, \
+        rl = ref_len, ql = qry_len, ra = int(ref_len * ref_cov / 100), rc = ref_cov, qa = int(qry_len * qry_cov / 100), qc = qry_cov, \
+        i = ident)
+
+
+def contig_lens(fi):
+    '''Name and length of each contig of a FastA.'''
+    ctgs = []
+    with open(fi, 'r') as f_in:
+        for line in f_in:
+            if line[0] == '>':
+                ctgs.append([line[1:].split()[0], 0])
+            else:
+                ctgs[-1][1] += len(line.strip())
+    return ctgs
+
+
+def stub_nucmer(argv): # Batch alignments (see dnadiff_group), with one alignment per query contig
+    opts, (ref, qry) = parse_opts(argv)
+    r_name, r_len = contig_lens(ref)[0]
+    with open(opts['-p'] + '.delta', 'w') as f_out:
+        f_out.write('{} {}\nNUCMER\n'.format(abspath(ref), abspath(qry)))
+        for name, n in contig_lens(qry):
+            f_out.write('>{} {} {} {}\n1 {} 1 {} 0 0 0\n0\n'.format(r_name, name, r_len, n, min(n, r_len), min(n, r_len)))
+
+
+def stub_dnadiff(argv):
+    opts, pos = parse_opts(argv)
+    prefix = opts['-p']
+    if '-d' in opts: # From the delta of a batch alignment
+        ref, qry = open(opts['-d'], 'r').readline().split()
+    else:
+        ref, qry = pos
+    with open(prefix + '.report', 'w') as f_out:
+        f_out.write(dnadiff_report(ref, qry, mag_rng(qry)))
+    for suffix in ['.delta', '.1delta', '.mdelta', '.1coords', '.mcoords', '.snps', '.qdiff', '.rdiff', '.unqry', '.unref']:
+        if suffix != '.delta' or '-d' not in opts:
+            open(prefix + suffix, 'w').close()
+
+
+QUAST_ROWS = ['# contigs', 'Total length', 'Genome fraction (%)', 'NG50', 'NA50', '# misassemblies', '# misassembled contigs', \
+    'Misassembled contigs length', '# unaligned contigs', 'Unaligned length']
+
+
+def quast_report(fas, labels):
+    cols = []
+    for fa in fas:
+        rng = mag_rng(fa)
+        n_ctgs, size, _, n50 = fasta_stats(fa)
+        mis = rng.randint(0, 2)
+        cols.append([str(n_ctgs), str(size), '{:.3f}'.format(rng.uniform(20, 100)), str(n50), str(n50), str(mis), str(mis), \
+            str(mis * n50), '{} + 0 part'.format(rng.randint(0, n_ctgs)), str(rng.randint(0, size // 10))])
+    txt = 'Assembly\t' + '\t'.join(labels) + '\n'
+    return txt + ''.join('{}\t{}\n'.format(r, '\t'.join(c[i] for c in cols)) for i, r in enumerate(QUAST_ROWS))
+
+
+def stub_quast(argv):
+    opts, fas = parse_opts(argv)
+    out = opts['-o']
+    labels = opts['-l'].split(',') if '-l' in opts else [basename(fa).rsplit('.', 1)[0] for fa in fas]
+    makedirs(join(out, 'contigs_reports'), exist_ok = True)
+    txt = quast_report(fas, labels)
+    for f in ['report.tsv', 'report.txt', 'transposed_report.tsv']:
+        with open(join(out, f), 'w') as f_out:
+            f_out.write(txt)
+    open(join(out, 'contigs_reports', 'all_alignments.tsv'), 'w').close()
+
+
+def stub_prokka(argv):
+    opts, pos = parse_opts(argv)
+    out, prefix = opts['--outdir'], opts['--prefix']
+    makedirs(out, exist_ok = True)
+    rng = mag_rng(pos[0])
+    n_ctgs, size, _, _ = fasta_stats(pos[0])
+    rrnas = [p for p in ['5S ribosomal RNA', '16S ribosomal RNA', '23S ribosomal RNA'] if rng.random() < 0.5]
+    num_cds = size // 1000
+    with open(join(out, prefix + '.txt'), 'w') as f_out:
+        f_out.write('organism: Genus species strain \ncontigs: {}\nbases: {}\nCDS: {}\nrRNA: {}\ntRNA: {}\n'.format( \
+            n_ctgs, size, num_cds, len(rrnas), rng.randint(10, 40)))
+    with open(join(out, prefix + '.tsv'), 'w') as f_out:
+        f_out.write('locus_tag\tftype\tlength_bp\tgene\tEC_number\tCOG\tproduct\n')
+        for i in range(num_cds):
+            f_out.write('{}_{:05d}\tCDS\t900\t\t\t\thypothetical protein\n'.format(prefix, i + 1))
+        for i, p in enumerate(rrnas):
+            f_out.write('{}_{:05d}\trRNA\t1500\t\t\t\t{}\n'.format(prefix, num_cds + i + 1, p))
+    for suffix in ['.gff', '.gbk', '.faa', '.ffn', '.fna', '.fsa', '.sqn', '.tbl', '.err', '.log']:
+        open(join(out, prefix + suffix), 'w').close()
+
+
+def stub_samtools(argv):
+    '''samtools index: an index of a BAM without reads (see write_bam).'''
+    bam = argv[-1]
+    with gzip.open(bam, 'rb') as f_in: # BGZF reads as multi-member gzip
+        data = f_in.read()
+    l_text = struct.unpack_from('<i', data, 4)[0]
+    n_ref = struct.unpack_from('<i', data, 8 + l_text)[0]
+    with open(bam + '.bai', 'wb') as f_out:
+        f_out.write(b'BAI\x01' + struct.pack('<i', n_ref) + struct.pack('<ii', 0, 0) * n_ref)
+
+
+def write_stubs(bin_dir):
+    '''Put an executable for each tool on bin_dir that runs its stand-in in this script.'''
+    makedirs(bin_dir, exist_ok = True)
+    for tool in STUBS:
+        fo = join(bin_dir, tool)
+        with open(fo, 'w') as f_out:
+            f_out.write('#!{}\nimport sys\nsys.path.insert(0, {!r})\nfrom bench_suite import run_stub\nrun_stub({!r}, sys.argv[1:])\n' \
+                .format(sys.executable, SCRIPT_DIR, tool))
+        os.chmod(fo, 0o755)
+
+
+def run_stub(tool, argv):
+    {'checkm2': stub_checkm2, 'checkm': stub_checkm, 'gunc': stub_gunc, 'gtdbtk': stub_gtdbtk, 'nucmer': stub_nucmer, 'dnadiff': stub_dnadiff, \
+     'quast.py': stub_quast, 'prokka': stub_prokka, 'samtools': stub_samtools}[tool](argv)
+
+
+# --- Benchmarks --- #
+
+
+def timed(f, *args, **kwargs):
+    start = time.perf_counter()
+    f(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def snakemake_cmd(work_dir, samples, db_dir, extra, config = ()):
+    return [sys.executable, '-m', 'snakemake', '--snakefile', join(MAIN_DIR, 'workflow', 'Snakefile'), \
+        '--config', 'work_dir=' + work_dir, 'samples=' + samples, 'ext=' + join(MAIN_DIR, 'workflow', 'ext'), 'gtdb_db=' + db_dir, *config, \
+        '--configfiles', join(MAIN_DIR, 'test_data', 'parameters.yaml'), join(MAIN_DIR, 'test_data', 'resources.yaml'), *extra]
+
+
+def bench_ingest(tmp, samples, args):
+    sys.path.insert(0, join(MAIN_DIR, 'workflow'))
+    from utils import ingest_samples
+    ingest_tmp = join(tmp, 'ingest')
+    makedirs(ingest_tmp)
+    return {'ingest_cold': timed(ingest_samples, samples, ingest_tmp, args.cores), \
+        'ingest_warm': timed(ingest_samples, samples, ingest_tmp, args.cores)}
+
+
+def bench_dag(tmp, samples, args):
+    work_dir = join(tmp, 'dag')
+    makedirs(work_dir)
+    cmd = snakemake_cmd(work_dir, samples, join(tmp, 'gtdb'), ['-n', '--quiet', '-c1'])
+    run = lambda: subprocess.run(cmd, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, check = True, cwd = work_dir)
+    return {'dag_cold': timed(run), 'dag_warm': timed(run)}
+
+
+def bench_python_rules(tmp, samples, args):
+    '''The Python rules and scripts of one sample's reports, on the stand-ins' outputs.'''
+    sys.path.insert(0, join(MAIN_DIR, 'workflow'))
+    from utils import aggregate_quast, parse_dnadiff, Ref_Index, get_mag_refs, ingest_samples
+    d = join(tmp, 'rules')
+    ing = join(d, 'tmp')
+    makedirs(ing)
+    s = ingest_samples(samples, ing, args.cores)[0]
+    bin_dir = join(ing, s)
+    bins = [l.strip() for l in open(join(ing, s + '.out'))]
+    res = {}
+    # Inputs, as the tools would write them
+    stub_gtdbtk(['classify_wf', '--genome_dir', bin_dir, '--out_dir', join(d, 'gtdbtk'), '-x', 'fa'])
+    ref_index = Ref_Index(join(tmp, 'gtdb'), join(d, 'ref_store'))
+    res['get_mag_refs'] = timed(get_mag_refs, join(d, 'gtdbtk', 'gtdbtk.bac120.summary.tsv'), ref_index, join(d, 'mag_refs.tsv'))
+    reps = []
+    refs = dict(l.rstrip('\n').split('\t')[::2] for l in open(join(d, 'mag_refs.tsv')).readlines()[1:])
+    makedirs(join(d, 'dnadiff'))
+    for b in bins:
+        if refs.get(b, 'None') != 'None':
+            with gzip.open(refs[b], 'rt') as f_in, open(join(d, 'ref.fa'), 'w') as f_out:
+                f_out.write(f_in.read())
+            stub_dnadiff([join(d, 'ref.fa'), join(bin_dir, b + '.fa'), '-p', join(d, 'dnadiff', b)])
+        else:
+            open(join(d, 'dnadiff', b + '.report'), 'w').close()
+        reps.append(join(d, 'dnadiff', b))
+    res['parse_dnadiff'] = timed(lambda: [parse_dnadiff(r + '.report', r + '.diff.tsv') for r in reps])
+    quast_reps = []
+    for b in bins:
+        q = join(d, 'quast', b)
+        if refs.get(b, 'None') != 'None':
+            stub_quast(['-o', q, join(bin_dir, b + '.fa')])
+        else:
+            makedirs(q)
+            open(join(q, 'report.tsv'), 'w').close()
+        quast_reps.append(join(q, 'report.tsv'))
+    res['aggregate_quast'] = timed(aggregate_quast, quast_reps, join(d, 'quast.csv'))
+    for b in bins:
+        stub_prokka([join(bin_dir, b + '.fa'), '--outdir', join(d, 'prokka'), '--prefix', b])
+    script = lambda name, *a: subprocess.run([sys.executable, join(SCRIPT_DIR, name), *a], check = True, stdout = subprocess.DEVNULL)
+    res['summarize_gene_cts'] = timed(script, 'summarize_gene_cts.py', join(ing, s + '.out'), join(d, 'prokka'), \
+        join(d, 'gene_cts.csv'), '-t', str(args.cores))
+    stub_samtools(['index', join(ing, s + '.bam')])
+    res['calc_mag_ra'] = timed(script, 'calc_mag_ra.py', bin_dir, join(ing, s + '.out'), join(ing, s + '.bam'), \
+        join(ing, s + '.bam.bai'), join(d, 'mag_ra.csv'), '-t', str(args.cores))
+    stub_checkm2(['predict', '--input', bin_dir, '--output-directory', join(d, 'checkm2'), '-x', 'fa'])
+    stub_checkm(['lineage_wf', '-x', 'fa', '--tab_table', '-f', join(d, 'checkm.tsv'), bin_dir, join(d, 'checkm')])
+    stub_gunc(['run', '--input_dir', bin_dir, '--out_dir', join(d, 'gunc')])
+    with open(join(d, 'diff.tsv'), 'w') as f_out:
+        for r in reps:
+            f_out.write(open(r + '.diff.tsv').read())
+    res['summarize_reports'] = timed(script, 'summarize_reports.py', join(d, 'checkm2', 'quality_report.tsv'), \
+        join(d, 'checkm.tsv'), join(d, 'mag_ra.csv'), join(d, 'gunc', 'GUNC.progenomes_2.1.maxCSS_level.tsv'), \
+        join(d, 'gtdbtk', 'gtdbtk.bac120.summary.tsv'), join(d, 'diff.tsv'), join(d, 'quast.csv'), join(d, 'gene_cts.csv'), \
+        join(d, 'summary.csv'))
+    return res
+
+
+def run_workflow(work_dir, samples, tmp, args):
+    '''Run the workflow with the stand-ins on the PATH, returning its wall time and number of jobs.'''
+    makedirs(work_dir, exist_ok = True)
+    cmd = snakemake_cmd(work_dir, samples, join(tmp, 'gtdb'), ['-c', str(args.cores), '--restart-times', '0', \
+        '--keep-going', '--latency-wait', '60'], args.config)
+    env = dict(os.environ, PATH = join(tmp, 'bin') + os.pathsep + os.environ['PATH'])
+    start = time.perf_counter()
+    p = subprocess.run(cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, cwd = work_dir, env = env, text = True)
+    secs = time.perf_counter() - start
+    steps = re.findall(r'(\d+) of (\d+) steps \(100%\) done', p.stdout)
+    if p.returncode != 0 or not exists(join(work_dir, 'mag_qc', 'final_reports', 'complete.txt')):
+        sys.stderr.write(p.stdout[-5000:])
+        raise RuntimeError('The whole run failed in {}'.format(work_dir))
+    return secs, int(steps[-1][1]) if steps else 0
+
+
+def bench_e2e(tmp, samples, args):
+    secs, num_jobs = run_workflow(join(tmp, 'e2e'), samples, tmp, args)
+    return {'e2e': secs, 'e2e_jobs': num_jobs}
+
+
+def summaries(work_dir):
+    return {basename(fi): open(fi, 'r').read() for fi in glob.glob(join(work_dir, 'mag_qc', 'final_reports', '*.summary.csv'))}
+
+
+def bench_rerun(tmp, samples, args):
+    '''Re-runs of a finished working directory after a MAG is added to a sample, replaced, and removed again.
+
+    After each change, a single run has to leave the same summaries as a fresh run on the changed cohort does.
+    '''
+    cohort = join(tmp, 'rerun_cohort') # A copy, so that the other benchmarks' cohort is left as it is
+    shutil.copytree(dirname(samples), cohort, symlinks = True)
+    rerun_samples = join(cohort, 'samples.csv')
+    with open(rerun_samples, 'w') as f_out:
+        f_out.write(open(samples, 'r').read().replace(dirname(samples), cohort))
+    mag_dir = join(cohort, 'mags', 's0')
+    ext = '.fa.gz' if args.compress else '.fa'
+    added = join(mag_dir, 'bin.{}'.format(len(glob.glob(join(mag_dir, 'bin.*')))))
+    rng = random.Random(1)
+
+    def write_mag(prefix, num_ctgs):
+        write_fasta(prefix + '.fa', [('{}_{}'.format(basename(prefix), i), random_seq(rng, CTG_KBP * 1000)) \
+            for i in range(num_ctgs)], args.compress)
+
+    def add():
+        write_mag(added, max(1, args.mag_kbp // CTG_KBP))
+
+    def replace(): # Moved in over the old one, with another size so that every tool's results change
+        write_mag(join(cohort, 'bin.0'), max(1, args.mag_kbp // CTG_KBP) + 1)
+        os.replace(join(cohort, 'bin.0' + ext), join(mag_dir, 'bin.0' + ext))
+
+    def remove():
+        os.remove(added + ext)
+
+    work_dir = join(tmp, 'rerun')
+    run_workflow(work_dir, rerun_samples, tmp, args)
+    res = {}
+    for name, change in [('add', add), ('replace', replace), ('remove', remove)]:
+        change()
+        res['rerun_' + name], _ = run_workflow(work_dir, rerun_samples, tmp, args)
+        fresh = join(tmp, 'rerun_fresh_' + name)
+        run_workflow(fresh, rerun_samples, tmp, args)
+        got, want = summaries(work_dir), summaries(fresh)
+        stale = sorted(s for s in set(got) | set(want) if got.get(s) != want.get(s))
+        if stale:
+            raise RuntimeError('After a MAG was {}, the re-run in {} left summaries that differ from a fresh run\'s ({}): {}'.format( \
+                {'add': 'added', 'replace': 'replaced', 'remove': 'removed'}[name], work_dir, fresh, ', '.join(stale)))
+    return res
+
+
+BENCHES = {'ingest': bench_ingest, 'dag': bench_dag, 'python_rules': bench_python_rules, 'e2e': bench_e2e, 'rerun': bench_rerun}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = MAIN_DIR, stdout = subprocess.PIPE, \
+            stderr = subprocess.DEVNULL, text = True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main(args):
+    meta = {'time': datetime.datetime.now().isoformat(timespec = 'seconds'), 'commit': git_commit(), 'host': platform.node(), \
+        'python': platform.python_version(), 'cores': args.cores, 'mag_kbp': args.mag_kbp, 'compressed': args.compress, 'config': args.config}
+    print('bench\tnum_samples\tnum_bins\tvalue', flush = True)
+    for n in args.num_bins:
+        benches = [b for b in args.benches if b not in ['e2e', 'rerun'] or n <= args.max_e2e_bins]
+        with tempfile.TemporaryDirectory(dir = args.tmp_dir) as tmp:
+            accs = make_refs(join(tmp, 'gtdb'))
+            os.environ['BENCH_GTDB_REFS'] = ','.join(accs)
+            write_stubs(join(tmp, 'bin'))
+            samples = make_cohort(join(tmp, 'cohort'), args.num_samples, n, args.mag_kbp, args.compress)
+            for b in benches:
+                for k, v in BENCHES[b](tmp, samples, args).items():
+                    rec = dict(meta, bench = k, num_samples = args.num_samples, num_bins = n, \
+                        **({'jobs': v} if k.endswith('_jobs') else {'seconds': round(v, 4)}))
+                    print('{}\t{}\t{}\t{}'.format(k, args.num_samples, n, v if k.endswith('_jobs') else '{:.3f}'.format(v)), flush = True)
+                    with open(args.output, 'a') as f_out:
+                        f_out.write(json.dumps(rec) + '\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num_bins", type=lambda x: [int(i) for i in x.split(',')], default=[10, 100, 1000, 10000], \
+        help="Comma-separated numbers of MAGs per sample.")
+    parser.add_argument("--num_samples", type=int, default=1, help="Number of samples.")
+    parser.add_argument("--mag_kbp", type=int, default=20, help="Size of each MAG (kbp).")
+    parser.add_argument("--compress", action="store_true", help="Gzip the MAGs (to include decompression in ingest).")
+    parser.add_argument("--benches", type=lambda x: x.split(','), default=list(BENCHES), \
+        help="Comma-separated benchmarks to run (of {}).".format(', '.join(BENCHES)))
+    parser.add_argument("--max_e2e_bins", type=int, default=100, help="Only run whole runs up to this many MAGs per sample.")
+    parser.add_argument("--config", nargs="*", default=[], help="Extra KEY=VALUE settings for whole runs (ex. shard_size=4).")
+    parser.add_argument("-c", "--cores", type=int, default=4, help="Cores for whole runs (and threads for ingest and scripts).")
+    parser.add_argument("--tmp_dir", default=None, help="Where to write the cohorts (default: the system's temporary directory).")
+    parser.add_argument("-o", "--output", default="bench_results.jsonl", help="JSON Lines file to append the results to.")
+    args = parser.parse_args()
+    main(args)
@@ -1,44 +1,270 @@
 #!/usr/bin/env python
-"""calc_mag_ra.py 
+"""calc_mag_ra.py
 Calculate the average coverage of each MAG in the sample based on its member contig's coverage.
+
+Reads are counted directly from the coordinate-sorted BAM and its .bai index (no CheckM or pysam needed).
+The BAM is split into index-defined regions that are scanned by a pool of worker processes, one BGZF block
+at a time, so memory use does not depend on the depth of the BAM. Reads are filtered as in `checkm coverage`
+(CheckM >= 1.1, which also skips supplementary alignments): paired reads only count if they're mapped in a proper
+pair, unless --all_reads is given (as with `checkm coverage -a`). Unlike CheckM, unpaired reads (single-end libraries)
+always count, as CheckM would otherwise need -a for them to have any coverage.
 """
 
 
 import argparse
-import pandas as pd
+from multiprocessing import Pool
+from os.path import join
+import struct
+import zlib
+
+
+BAI_PSEUDO_BIN = 37450 # Holds the per-reference virtual offset range and read counts
+LINEAR_SHIFT = 14 # Linear index windows are 16 kbp
+SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400 | 0x800 # Unmapped, secondary, QC-fail, duplicate, supplementary
+PAIRED, PROPER_PAIR = 0x1, 0x2
+REF_OPS = (0, 2, 3, 7, 8) # CIGAR operations that consume the reference (M, D, N, =, X)
+QUER_OPS = (0, 1, 4, 7, 8) # CIGAR operations that consume the query (M, I, S, =, X)
+AUX_TYPES = {b'A': '<B', b'c': '<b', b'C': '<B', b's': '<h', b'S': '<H', b'i': '<i', b'I': '<I', b'f': '<f'} # Fixed-size tags
+MIN_UNIT_BYTES = 1 << 22 # Don't bother splitting the BAM into regions smaller than 4 MB (compressed)
+
+
+# --- BGZF/BAM/BAI parsing --- #
+
+
+class BgzfReader:
+    '''Sequential reader over the BGZF blocks of a BAM, starting from a virtual offset.'''
+
+    def __init__(self, fi, voffset = 0):
+        self.f_in = open(fi, 'rb')
+        self.f_in.seek(voffset >> 16)
+        self.buf = self.next_block() or b''
+        self.pos = voffset & 0xFFFF
+
+    def next_block(self):
+        header = self.f_in.read(12)
+        if len(header) < 12: # End of file
+            return None
+        xlen = struct.unpack_from('<H', header, 10)[0]
+        extra = self.f_in.read(xlen)
+        i = 0
+        bsize = None
+        while i < xlen: # Find the BC subfield, which holds the total block size
+            si1, si2, slen = struct.unpack_from('<BBH', extra, i)
+            if si1 == 66 and si2 == 67:
+                bsize = struct.unpack_from('<H', extra, i + 4)[0]
+            i += 4 + slen
+        if bsize is None:
+            raise ValueError('{} is not a BGZF-compressed file'.format(self.f_in.name))
+        cdata = self.f_in.read(bsize - xlen - 19)
+        self.f_in.read(8) # CRC32 and ISIZE
+        return zlib.decompress(cdata, -15)
+
+    def read(self, n):
+        # Top up the buffer with as many blocks as needed (handles records that span blocks)
+        while len(self.buf) - self.pos < n:
+            block = self.next_block()
+            if block is None:
+                break
+            self.buf = self.buf[self.pos:] + block
+            self.pos = 0
+        out = self.buf[self.pos:self.pos + n]
+        self.pos += len(out)
+        return out
+
+    def close(self):
+        self.f_in.close()
+
+
+def read_bam_header(bam):
+    f_in = BgzfReader(bam)
+    if f_in.read(4) != b'BAM\x01':
+        raise ValueError('{} is not a BAM file'.format(bam))
+    l_text = struct.unpack('<i', f_in.read(4))[0]
+    f_in.read(l_text)
+    n_ref = struct.unpack('<i', f_in.read(4))[0]
+    ref_names = []
+    for _ in range(n_ref):
+        l_name = struct.unpack('<i', f_in.read(4))[0]
+        ref_names.append(f_in.read(l_name)[:-1].decode())
+        f_in.read(4) # l_ref
+    f_in.close()
+    return ref_names
+
+
+def read_bai(bai):
+    '''Return the [beg, end) virtual offsets and linear index of each reference in the BAM.'''
+    with open(bai, 'rb') as f_in:
+        data = f_in.read()
+    if data[:4] != b'BAI\x01':
+        raise ValueError('{} is not a BAM index'.format(bai))
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    i = 8
+    refs = []
+    for _ in range(n_ref):
+        n_bin = struct.unpack_from('<i', data, i)[0]
+        i += 4
+        beg = end = None
+        chunk_beg = chunk_end = None
+        for _ in range(n_bin):
+            b, n_chunk = struct.unpack_from('<Ii', data, i)
+            i += 8
+            chunks = struct.unpack_from('<%dQ' % (2 * n_chunk), data, i)
+            i += 16 * n_chunk
+            if b == BAI_PSEUDO_BIN:
+                beg, end = chunks[0], chunks[1]
+            elif n_chunk:
+                chunk_beg = min(chunks[0::2]) if chunk_beg is None else min(chunk_beg, *chunks[0::2])
+                chunk_end = max(chunks[1::2]) if chunk_end is None else max(chunk_end, *chunks[1::2])
+        if beg is None: # Indexers that don't write the pseudo-bin
+            beg, end = chunk_beg, chunk_end
+        n_intv = struct.unpack_from('<i', data, i)[0]
+        i += 4
+        ioffsets = struct.unpack_from('<%dQ' % n_intv, data, i)
+        i += 8 * n_intv
+        refs.append((beg, end, ioffsets))
+    return refs
+
+
+# --- Work partitioning --- #
+
+
+def split_regions(refs, threads):
+    '''Partition the BAM into (start key, seek offset, end key) units of roughly equal compressed size.'''
+    sizes = [((e >> 16) - (b >> 16) + 1) if b is not None else 0 for b, e, _ in refs]
+    target = max(sum(sizes) // (threads * 4), MIN_UNIT_BYTES)
+    # Break each reference into pieces, splitting the big ones along their linear index
+    pieces = []
+    for r, (beg, _, ioffsets) in enumerate(refs):
+        if beg is None: # No reads were mapped to this reference
+            continue
+        if sizes[r] <= target or len(ioffsets) < 2:
+            pieces.append(((r, 0), beg, sizes[r]))
+            continue
+        step = max(1, len(ioffsets) * target // sizes[r])
+        for w in range(0, len(ioffsets), step):
+            voffset = ioffsets[w] if w and ioffsets[w] else beg
+            pieces.append(((r, w << LINEAR_SHIFT), voffset, sizes[r] * min(step, len(ioffsets) - w) // len(ioffsets)))
+    # Pack consecutive pieces into units, each of which ends where the next one starts
+    units = []
+    acc = 0
+    for key, voffset, size in pieces:
+        if not units or acc >= target:
+            units.append([key, voffset, None])
+            acc = 0
+        acc += size
+    for j in range(len(units) - 1):
+        units[j][2] = units[j + 1][0]
+    if units:
+        units[-1][2] = (len(refs), 0)
+    return [tuple(u) for u in units]
+
+
+# --- Read counting --- #
+
+
+def get_nm(buf, i, end):
+    while i < end: # Walk the auxiliary fields until NM is found
+        tag = buf[i:i + 2]
+        t = buf[i + 2:i + 3]
+        i += 3
+        if t in AUX_TYPES:
+            if tag == b'NM':
+                return struct.unpack_from(AUX_TYPES[t], buf, i)[0]
+            i += struct.calcsize(AUX_TYPES[t])
+        elif t == b'Z' or t == b'H':
+            i = buf.index(b'\x00', i) + 1
+        elif t == b'B':
+            sub = buf[i:i + 1]
+            n = struct.unpack_from('<i', buf, i + 1)[0]
+            i += 5 + n * struct.calcsize(AUX_TYPES[sub])
+        else:
+            break
+    return 0
+
+
+def count_region(args):
+    '''Sum the reference-aligned bases of reads that pass the filters for each reference in a unit.'''
+    bam, (start, voffset, stop), min_align, max_edit, all_reads = args
+    f_in = BgzfReader(bam, voffset)
+    aln_bases = {}
+    while True:
+        raw = f_in.read(4)
+        if len(raw) < 4:
+            break
+        block_size = struct.unpack('<i', raw)[0]
+        rec = f_in.read(block_size)
+        ref_id, pos, l_read_name, _, _, n_cigar_op, flag, l_seq = struct.unpack_from('<iiBBHHHi', rec, 0)
+        if ref_id < 0 or (ref_id, pos) >= stop: # Unplaced reads are sorted to the end
+            break
+        if (ref_id, pos) < start or flag & SKIP_FLAGS:
+            continue
+        if not all_reads and flag & PAIRED and not flag & PROPER_PAIR: # Discordant or mate unmapped
+            continue
+        i = 32 + l_read_name
+        cigar = struct.unpack_from('<%dI' % n_cigar_op, rec, i)
+        alen = sum(c >> 4 for c in cigar if (c & 0xF) in REF_OPS)
+        rlen = l_seq if l_seq else sum(c >> 4 for c in cigar if (c & 0xF) in QUER_OPS)
+        if alen < min_align * rlen:
+            continue
+        i += 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq
+        if get_nm(rec, i, len(rec)) > max_edit * rlen:
+            continue
+        aln_bases[ref_id] = aln_bases.get(ref_id, 0) + alen
+    f_in.close()
+    return aln_bases
+
+
+# --- MAG coverage --- #
+
+
+def load_ctg_lens(fi):
+    ctg_lens = {}
+    ctg = None
+    with open(fi, 'r', buffering = 1 << 20) as f_in:
+        for line in f_in:
+            if line[0] == '>':
+                ctg = line[1:].split(maxsplit = 1)[0] if line[1:].strip() else ''
+                ctg_lens[ctg] = 0
+            elif ctg is not None:
+                ctg_lens[ctg] += len(line.rstrip())
+    return ctg_lens
 
 
 def main(args):
-    # Load the TSV file into a pandas DataFrame
-    df = pd.read_csv(args.f_in, sep='\t')
-    
-    # Get rid of the unbinned contigs
-    df = df[df['Bin Id'] != 'unbinned']
-    
-    # Group the data by 'Bin Id' and calculate the weighted average of 'Coverage' by 'Sequence length (bp)'
-    df['Weighted Coverage'] = df['Coverage'] * df['Sequence length (bp)']
-    
-    # Calculate the total length of sequences for each MAG
-    total_length_per_mag = df.groupby('Bin Id')['Sequence length (bp)'].sum()
-    
-    # Calculate the total weighted coverage for each MAG
-    total_weighted_coverage_per_mag = df.groupby('Bin Id')['Weighted Coverage'].sum()
-    
-    # Calculate the average coverage for each MAG
-    average_coverage_per_mag = total_weighted_coverage_per_mag / total_length_per_mag
-    
-    # Add columns
-    final_df = pd.DataFrame(average_coverage_per_mag).reset_index()
-    final_df.columns = ['mag', 'avg_read_cov']
-    final_df['avg_mag_ra'] = final_df['avg_read_cov'] / final_df['avg_read_cov'].sum()
-    final_df = final_df[['mag', 'avg_mag_ra']]
-    final_df.to_csv(args.f_out, header = True, index = False)
-    
+    bins = [l.strip() for l in open(args.bin_lst, 'r') if l.strip()]
+    ref_ids = {r: i for i, r in enumerate(read_bam_header(args.bam))}
+    units = split_regions(read_bai(args.bai), args.threads)
+    # Count the aligned bases per contig, one BAM region per task
+    aln_bases = [0] * len(ref_ids)
+    tasks = [(args.bam, u, args.min_align, args.max_edit, args.all_reads) for u in units]
+    with Pool(max(1, min(args.threads, len(tasks)))) as pool:
+        for res in pool.imap_unordered(count_region, tasks):
+            for r, b in res.items():
+                aln_bases[r] += b
+    # The length-weighted average of contig coverage is total aligned bases over total MAG size
+    mag_cov = []
+    for b in bins:
+        ctg_lens = load_ctg_lens(join(args.bin_dir, b + '.fa'))
+        tot_len = sum(ctg_lens.values())
+        tot_aln = sum(aln_bases[ref_ids[c]] for c in ctg_lens if c in ref_ids)
+        mag_cov.append(tot_aln / tot_len if tot_len else 0.0)
+    tot_cov = sum(mag_cov)
+    with open(args.f_out, 'w') as f_out:
+        f_out.write('mag,avg_mag_ra\n')
+        for b, c in zip(bins, mag_cov):
+            f_out.write('{},{}\n'.format(b, repr(c / tot_cov) if tot_cov else ''))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("f_in", help="Input contig coverage TSV.")
+    parser.add_argument("bin_dir", help="Directory of MAG FastAs ({bin_num}.fa).")
+    parser.add_argument("bin_lst", help="List of MAG IDs in the sample.")
+    parser.add_argument("bam", help="Coordinate-sorted BAM of reads mapped to the sample's contigs.")
+    parser.add_argument("bai", help="BAM index.")
     parser.add_argument("f_out", help="Output MAG coverage CSV")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of worker processes.")
+    parser.add_argument("--min_align", type=float, default=0.98, help="Minimum proportion of the read that has to align.")
+    parser.add_argument("--max_edit", type=float, default=0.02, help="Maximum edit distance as a proportion of the read length.")
+    parser.add_argument("--all_reads", action="store_true", help="Also count paired reads that aren't mapped in a proper pair.")
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""split_quast_report.py
+Split a QUAST report of all of the MAGs aligned to one reference genome into one report per MAG.
+"""
+
+
+import argparse
+import csv
+from os import makedirs
+from os.path import join
+
+
+def main(args):
+    members = [l.rstrip('\n').split('\t') for l in open(args.f_grp, 'r') if l.strip()]
+    with open(args.f_rep, 'r') as f_in:
+        rows = list(csv.reader(f_in, delimiter = '\t'))
+    # Assemblies were labelled by their line in the group file, in order
+    for i, m in enumerate(members):
+        makedirs(m[5], exist_ok = True)
+        with open(join(m[5], 'report.tsv'), 'w') as f_out:
+            f_out.write('Assembly\t{}\n'.format(m[1]))
+            for r in rows[1:]:
+                f_out.write('{}\t{}\n'.format(r[0], r[i + 1] if i + 1 < len(r) else '-'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("f_grp", help="MAGs aligned to the reference genome (group TSV).")
+    parser.add_argument("f_rep", help="Combined QUAST report TSV.")
+    args = parser.parse_args()
+    main(args)
@@ -1,20 +1,24 @@
 #!/usr/bin/env python
-"""summarize_gene_cts.py 
-Summarizes the number of CDSes, mRNAs, tRNAs, total rRNAs, and 23S, 16S, and 5S rRNAs found in a MAG.
+"""summarize_gene_cts.py
+Summarizes the number of CDSes, tRNAs, total rRNAs, and 5S, 16S, and 23S rRNAs found in each of a sample's MAGs.
 """
 
 
 import argparse
-import pandas as pd
+from multiprocessing import Pool
+from os.path import join
 
 
-# Create an empty dictionary to store the counts
-def main(args):
+MIN_MAGS_PER_WORKER = 50 # Below this, parsing in one process is faster than starting a pool
+
+
+def count_genes(args):
+    '''Count the genes of one MAG from its Prokka summary, and its rRNAs from the feature table.'''
+    prokka_dir, mag = args
     data = {'CDS': 0, 'tRNA': 0, 'rRNA_total': 0, 'rRNA_5s': 0, 'rRNA_16s': 0, 'rRNA_23s': 0}
-    
     # Open the file and extract counts
-    with open(args.f_summ, 'r') as file:
-        for line in file:
+    with open(join(prokka_dir, mag + '.txt'), 'r') as f_in:
+        for line in f_in:
             line = line.strip()
             if line.startswith('CDS:'):
                 data['CDS'] = int(line.split(': ')[1])
@@ -22,32 +26,48 @@ def main(args):
                 data['tRNA'] = int(line.split(': ')[1])
             elif line.startswith('rRNA:'):
                 data['rRNA_total'] = int(line.split(': ')[1])
-    
     if data['rRNA_total'] != 0:
-        # Read the TSV file into a pandas DataFrame
-        df = pd.read_csv(args.f_all, sep='\t')
-        # Filter rows where the 'ftype' column is 'rRNA'
-        rrna_df = df[df['ftype'] == 'rRNA']
-        # Count occurrences of each rRNA type in the 'product' column
-        for product in rrna_df['product']:
-            if '5S' in product:
-                data['rRNA_5s'] += 1
-            elif '16S' in product:
-                data['rRNA_16s'] += 1
-            elif '23S' in product:
-                data['rRNA_23s'] += 1
-    
-    # Convert the dictionary to a pandas DataFrame
-    df = pd.DataFrame(data, index = [args.mag])
-    df.rename(columns = {'index': 'mag'}, inplace = True)
-    df.to_csv(args.f_out, header = False, index = True)
-    
+        # Stream the feature table, only looking at the products of rRNA rows
+        with open(join(prokka_dir, mag + '.tsv'), 'r') as f_in:
+            header = f_in.readline().rstrip('\n').split('\t')
+            if 'ftype' not in header or 'product' not in header:
+                raise ValueError('{} is missing the ftype or product column'.format(f_in.name))
+            i_ftype = header.index('ftype')
+            i_prod = header.index('product')
+            for line in f_in:
+                cols = line.rstrip('\n').split('\t')
+                if cols[i_ftype] != 'rRNA':
+                    continue
+                # Count occurrences of each rRNA type in the 'product' column
+                product = cols[i_prod] if i_prod < len(cols) else ''
+                if '5S' in product:
+                    data['rRNA_5s'] += 1
+                elif '16S' in product:
+                    data['rRNA_16s'] += 1
+                elif '23S' in product:
+                    data['rRNA_23s'] += 1
+    return [mag] + list(data.values())
+
+
+def main(args):
+    mags = [l.strip() for l in open(args.bin_lst, 'r') if l.strip()]
+    tasks = [(args.prokka_dir, m) for m in mags]
+    num_workers = min(args.threads, len(mags) // MIN_MAGS_PER_WORKER)
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            rows = pool.map(count_genes, tasks, chunksize = MIN_MAGS_PER_WORKER)
+    else:
+        rows = [count_genes(t) for t in tasks]
+    with open(args.f_out, 'w') as f_out:
+        for r in rows:
+            f_out.write(','.join(str(c) for c in r) + '\n')
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("f_summ", help="Prokka summary TXT.")
-    parser.add_argument("f_all", help="Prokka extended contig-gene annotation TSV")
-    parser.add_argument("mag", help="MAG ID")
+    parser.add_argument("bin_lst", help="List of MAG IDs in the sample.")
+    parser.add_argument("prokka_dir", help="Directory of Prokka outputs ({bin_num}.txt and {bin_num}.tsv).")
     parser.add_argument("f_out", help="Output gene count CSV.")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of worker processes.")
     args = parser.parse_args()
     main(args)
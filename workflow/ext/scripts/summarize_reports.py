@@ -1,80 +1,107 @@
+#!/usr/bin/env python
+"""summarize_reports.py
+Join the per-sample reports of all of the QC tools into one table with a row per MAG.
+"""
+
+
 import argparse
-import os
 from os.path import getsize
 import pandas as pd
-from math import log10
 import numpy as np
 
-def main(args): # A FastA file
-    # Load completeness and contamination (mag,completeness,contamination)
-    raw_df = pd.read_csv(args.checkm2, header = 0, sep = '\t')
-    summ_df = raw_df[['Name', 'Completeness', 'Contamination', 'Contig_N50', 'Genome_Size', 'GC_Content']]
-    summ_df.columns = ['mag', 'completeness', 'contamination', 'N50', 'size', 'GC']
-    summ_df['mag'] = summ_df['mag'].astype(str)  # Otherwise, interpreted as int
-    summ_df['completeness'] = summ_df['completeness'].astype(float)  # Otherwise, interpreted as str
-    summ_df['contamination'] = summ_df['contamination'].astype(float)  # Otherwise, interpreted as str
-    summ_df['N50'] = summ_df['N50'].astype(int)  # Otherwise, interpreted as str
+
+# Columns used from each report as {column: (name in summary, dtype)}
+CHECKM2_COLS = {'Name': ('mag', str), 'Completeness': ('completeness', float), 'Contamination': ('contamination', float), \
+    'Contig_N50': ('N50', 'Int64'), 'Genome_Size': ('size', 'Int64'), 'GC_Content': ('GC', float)}
+STRAIN_COLS = {'Bin Id': ('mag', str), 'Strain heterogeneity': ('strain_het', float)}
+RA_COLS = {'mag': ('mag', str), 'avg_mag_ra': ('avg_mag_ra', float)}
+GUNC_COLS = {'genome': ('mag', str), 'clade_separation_score': ('clade_separation_score', float), \
+    'n_effective_surplus_clades': ('n_effective_surplus_clades', float)}
+GENE_CTS_COLS = {c: (c, str if c == 'mag' else 'Int64') for c in \
+    ['mag', 'num_cds', 'num_trna', 'num_rrna_total', 'num_rrna_5s', 'num_rrna_16s', 'num_rrna_23s']} # No header
+GTDB_COLS = {'user_genome': ('mag', str), 'classification': ('classification', str)}
+DIFF_COLS = {'mag': ('mag', str), 'ref': ('ref', str), 'ref_len': ('ref_len', 'Int64'), 'ref_cov': ('ref_cov', float), \
+    'bin_size': ('bin_size', 'Int64'), 'bin_cov': ('bin_cov', float), 'ANI': ('ANI', float)} # No header
+QUAST_COLS = {'mag': ('mag', str), 'genome_fraction': ('genome_fraction', float), 'NG50': ('NG50', 'Int64'), \
+    'NA50': ('NA50', 'Int64'), 'num_misassemb': ('num_misassemb', 'Int64'), 'prop_misassemb_ctgs': ('prop_misassemb_ctgs', float), \
+    'prop_misassemb_len': ('prop_misassemb_len', float), 'prop_unaln_ctgs': ('prop_unaln_ctgs', float), \
+    'prop_unaln_len': ('prop_unaln_len', float)}
+
+
+def load_report(fi, cols, sep = ',', header = True):
+    '''Load the used columns of a report, typed and renamed as in cols, and indexed by MAG ID.'''
+    if header:
+        with open(fi, 'r') as f_in:
+            found = f_in.readline().rstrip('\n').split(sep)
+        missing = [c for c in cols if c not in found]
+        if missing:
+            raise ValueError('{} is missing the column(s) {} (found: {})'.format(fi, ', '.join(missing), ', '.join(found)))
+        df = pd.read_csv(fi, sep = sep, usecols = list(cols), dtype = {c: t for c, (_, t) in cols.items()})
+    else:
+        with open(fi, 'r') as f_in:
+            num_found = len(f_in.readline().split(sep))
+        if num_found != len(cols):
+            raise ValueError('{} has {} columns, expected {} ({})'.format(fi, num_found, len(cols), ', '.join(cols)))
+        df = pd.read_csv(fi, sep = sep, header = None, names = list(cols), dtype = {c: t for c, (_, t) in cols.items()})
+    df = df[list(cols)].rename(columns = {c: n for c, (n, _) in cols.items()}).set_index('mag')
+    dups = df.index[df.index.duplicated()].unique()
+    if len(dups):
+        raise ValueError('{} has more than one row for the MAG(s) {}'.format(fi, ', '.join(dups)))
+    return df
+
+
+def main(args):
+    # Load completeness, contamination, and assembly statistics
+    summ_df = load_report(args.checkm2, CHECKM2_COLS, sep = '\t')
     # Load strain heterogeneity
-    strain_df = pd.read_csv(args.checkm1, header = 0, sep = '\t')
-    strain_df = strain_df[['Bin Id', 'Strain heterogeneity']]
-    strain_df.columns = ['mag', 'strain_het']
-    strain_df['mag'] = strain_df['mag'].astype(str)  # Otherwise, interpreted as int
-    strain_df['strain_het'] = strain_df['strain_het'].astype(float)  # Otherwise, interpreted as str
+    strain_df = load_report(args.checkm1, STRAIN_COLS, sep = '\t')
     # Load MAG relative abundance
-    ra_df = pd.read_csv(args.mag_ra, header = 0)
-    ra_df['mag'] = ra_df['mag'].astype(str)  # Otherwise, interpreted as int
+    ra_df = load_report(args.mag_ra, RA_COLS)
     # Load taxonomy-based contamination
-    raw_df = pd.read_csv(args.gunc, header = 0, sep = '\t')
-    gunc_df = raw_df[['genome', 'clade_separation_score', 'n_effective_surplus_clades']]
-    gunc_df.rename(columns = {'genome' : 'mag'}, inplace = True)
-    gunc_df['mag'] = gunc_df['mag'].astype(str)  # Otherwise, interpreted as int
+    gunc_df = load_report(args.gunc, GUNC_COLS, sep = '\t')
     # Load MAG tRNA and rRNA gene content
-    gene_cts_df = pd.read_csv(args.gene_cts, header = None)
-    gene_cts_df.columns = ['mag', 'num_cds', 'num_trna', 'num_rrna_total', 'num_rrna_5s', 'num_rrna_16s', 'num_rrna_23s']
-    gene_cts_df['mag'] = gene_cts_df['mag'].astype(str)  # Otherwise, interpreted as int
-    # gene_cts_df['mag'] = gene_cts_df.apply(lambda row : str(row[0]).split('.')[1], axis = 1) # Reshape bin.X into X
+    gene_cts_df = load_report(args.gene_cts, GENE_CTS_COLS, header = False)
     # Load classification results
     if getsize(args.gtdb) != 0: # If there were classification results
         # Load taxonomic classification (all levels)
-        raw_df = pd.read_csv(args.gtdb, sep = '\t')
-        gtdb_df = raw_df[['user_genome', 'classification']]
-        gtdb_df.columns = ['mag', 'classification']
-        gtdb_df['mag'] = gtdb_df['mag'].astype(str) # Otherwise, interpreted as int
+        gtdb_df = load_report(args.gtdb, GTDB_COLS, sep = '\t')
         # Load MAG-reference aligned length, reference genome coverage, ANI
-        raw_df = pd.read_csv(args.diff, sep = '\t', header = None)
-        raw_df[0] = raw_df.apply(lambda row : str(row[0]).split('/')[-1].replace('.fa','').replace('.report',''), axis = 1) # Reshape /path/to/X.* into X
-        raw_df.columns = ['mag', 'ref', 'ref_len', 'ref_cov', 'bin_size', 'bin_cov', 'ANI']
-        diff_df = raw_df[['mag', 'bin_cov', 'ref_cov', 'ANI']]
+        diff_df = load_report(args.diff, DIFF_COLS, sep = '\t', header = False)
+        # Reshape /path/to/X.* into X
+        diff_df.index = diff_df.index.str.rsplit('/', n = 1).str[-1].str.replace('.fa', '', regex = False) \
+            .str.replace('.report', '', regex = False).rename('mag')
+        diff_df = diff_df[['bin_cov', 'ref_cov', 'ANI']]
     else:
-        raw_lst = [[m, 'NA'] for m in summ_df['mag']]
-        gtdb_df = pd.DataFrame(raw_lst, columns = ['mag', 'classification'])
-        raw_lst = [[m, 'NA', 0, 0] for m in summ_df['mag']]
-        diff_df = pd.DataFrame(raw_lst, columns = ['mag', 'bin_cov', 'ref_cov', 'ANI'])
+        gtdb_df = pd.DataFrame({'classification': 'NA'}, index = summ_df.index)
+        diff_df = pd.DataFrame({'bin_cov': 'NA', 'ref_cov': 0, 'ANI': 0}, index = summ_df.index)
     if getsize(args.quast) != 0: # If there were classification results
         # Load reference genome-based completion, misassembly, and unaligned statistics from QUAST report
-        quas_df = pd.read_csv(args.quast, header = 0)
-        quas_df['mag'] = quas_df['mag'].astype(str)
+        quas_df = load_report(args.quast, QUAST_COLS)
     else:
-        raw_lst = [[m, 0, 0, 0, 'NA', 'NA', 'NA', 'NA', 'NA'] for m in summ_df['mag']]
-        quas_df = pd.DataFrame(raw_lst, columns = ['mag', 'genome_fraction', 'NG50', 'NA50', 'num_misassemb', 'prop_misassemb_ctgs', 'prop_misassemb_len', 'prop_unaln_ctgs', 'prop_unaln_len'])
-    # Put all of the dataframes together and output
-    for df in [gunc_df, strain_df, gene_cts_df, ra_df, gtdb_df, diff_df, quas_df]: # size_df, cmsq_df,
-        summ_df = pd.merge(summ_df, df, on = 'mag', how = 'outer')
+        quas_df = pd.DataFrame({'genome_fraction': 0, 'NG50': 0, 'NA50': 0, 'num_misassemb': 'NA', 'prop_misassemb_ctgs': 'NA', \
+            'prop_misassemb_len': 'NA', 'prop_unaln_ctgs': 'NA', 'prop_unaln_len': 'NA'}, index = summ_df.index)
+    # Put all of the dataframes together (all of the MAGs in any report) and output
+    summ_df = pd.concat([summ_df, gunc_df, strain_df, gene_cts_df, ra_df, gtdb_df, diff_df, quas_df], axis = 1, join = 'outer')
+    summ_df = summ_df.sort_index()
+    summ_df.index.name = 'mag'
     # Add in standard quality thresholds
+    comp = summ_df['completeness']
+    cont = summ_df['contamination']
+    full_rrna = (summ_df['num_trna'] >= 18) & (summ_df['num_rrna_5s'] > 0) & (summ_df['num_rrna_16s'] > 0) & (summ_df['num_rrna_23s'] > 0)
     conditions = [
-        ((summ_df['completeness'] < 50)& (summ_df['contamination'] < 10)),
-        ((summ_df['completeness'] > 50)& (summ_df['contamination'] > 10)),
-        ((summ_df['completeness'] >= 50) & (summ_df['completeness'] <= 90) & (summ_df['contamination'] < 10)),
-        ((summ_df['completeness'] > 90) & (summ_df['contamination'] > 5) & (summ_df['contamination'] < 10)),
-        ((summ_df['completeness'] > 90) & (summ_df['contamination'] <= 5)),
-        ((summ_df['completeness'] > 90) & (summ_df['contamination'] < 5) & (summ_df['num_trna'] >= 18) & (summ_df['num_rrna_5s'] > 0) & (summ_df['num_rrna_16s'] > 0) & (summ_df['num_rrna_23s'] > 0)),
+        ((comp < 50) & (cont < 10)),
+        ((comp > 50) & (cont > 10)),
+        ((comp >= 50) & (comp <= 90) & (cont < 10)),
+        ((comp > 90) & (cont > 5) & (cont < 10)),
+        ((comp > 90) & (cont <= 5)),
+        ((comp > 90) & (cont < 5) & full_rrna.fillna(False).astype(bool)),
     ]
     summ_df['MIMAG_Quality'] = np.select(conditions, ['Low', 'Low', 'Medium', 'Medium', 'High', 'Near_Complete'], default = 'NA')
     summ_df['GUNC_Status'] = np.where((summ_df['clade_separation_score'] < 0.45), 'Pass', 'Fail')
     # Defaults are A = 1, B = 0.5, C = 5, D = 1
-    summ_df['Overall_Score'] = summ_df.apply(lambda row : row[1] + 0.5 * log10(row[3]) - 5 * row[2], axis = 1)
-    # summ_df['completeness'] + 0.5 * log10(summ_df['N50']) - 5 * summ_df['contamination'] #  - row[8], - summ_df['strain_het']
-    summ_df.to_csv(args.output, header = True, index = False)
+    summ_df['Overall_Score'] = comp + 0.5 * np.log10(summ_df['N50'].astype(float)) - 5 * cont
+    # - summ_df['strain_het']
+    summ_df.reset_index().to_csv(args.output, header = True, index = False)
 
 
 if __name__ == "__main__":
@@ -88,5 +115,5 @@ if __name__ == "__main__":
     parser.add_argument("quast", help="QUAST report")
     parser.add_argument("gene_cts", help="rRNA and total gene counts")
     parser.add_argument("output", help="Summary output")
-    args = parser.parse_args() 
+    args = parser.parse_args()
     main(args)
@@ -7,10 +7,9 @@ from io import StringIO
 #from os import getcwd, makedirs
 #from os.path import abspath, dirname, exists, join
 import os
-import pandas as pd
 from snakemake import snakemake, main
 from shutil import rmtree
-from utils import Workflow_Dirs, print_cmds, cleanup_files, get_conda_prefix
+from utils import Workflow_Dirs, print_cmds, cleanup_files, get_conda_prefix, query_store, cohort_report, print_resources, profile_jobs, print_profile, Runtime_Model, print_plan
 
 @click.group(cls = DefaultGroup, default = 'run', default_if_no_args = True)
 def cli():
@@ -80,11 +79,13 @@ def cmd_line(workflow, work_dir, samples, env_yamls, pyaml, ryaml, cores, env_di
     help = 'Run workflow by submitting rules as Slurm cluster jobs')
 @click.option('--dry_run', is_flag = True, default = False, \
     help = 'Set up directory structure and print workflow commands to be run separately')
+@click.option('--plan', is_flag = True, default = False, \
+    help = 'Predict the makespan of the remaining jobs from the runtime model (see profile) without running them')
 @click.option('--unlock', is_flag = True, default = False, \
     help = 'Remove a lock on the work directory')
 @click.option('--version', is_flag = True, default = False, \
     help = 'Check the module version')
-def run(cores, work_dir, samples, parameters, resources, slurm, dry_run, unlock, version): # unit_test
+def run(cores, work_dir, samples, parameters, resources, slurm, dry_run, plan, unlock, version): # unit_test
     # Get the absolute path of the Snakefile to find the profile configs
     main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # /path/to/main_dir/workflow/cli.py
     workflow = os.path.join(main_dir, 'workflow', 'Snakefile')
@@ -120,6 +121,16 @@ def run(cores, work_dir, samples, parameters, resources, slurm, dry_run, unlock,
     if slurm:
         sbatch(workflow, work_dir, samples, env_yamls, pyaml, ryaml,     \
                cores, env_dir, os.path.join(main_dir, 'configs', 'sbatch'))
+    elif plan:
+        import yaml
+        Workflow_Dirs(work_dir, 'mag_qc')
+        f = StringIO()
+        with redirect_stdout(f):
+            cmd_line(workflow, work_dir, samples, env_yamls, pyaml, ryaml,   \
+                     cores, env_dir, True, False)
+        with open(ryaml, 'r') as f_in:
+            model = yaml.safe_load(f_in).get('runtime_model')
+        print_plan(f.getvalue(), work_dir, Runtime_Model(model if model else os.path.join(work_dir, 'logs', 'runtime_model.json')), cores)
     elif dry_run:
         # Set up the directory structure skeleton
         Workflow_Dirs(work_dir, 'mag_qc')
@@ -129,6 +140,7 @@ def run(cores, work_dir, samples, parameters, resources, slurm, dry_run, unlock,
             cmd_line(workflow, work_dir, samples, env_yamls, pyaml, ryaml,   \
                      cores, env_dir, True, False) # unit_test_dir
         print_cmds(f.getvalue())
+        print_resources(f.getvalue())
     else:
         cmd_line(workflow, work_dir, samples, env_yamls, pyaml, ryaml,   \
                  cores, env_dir, False, False) # unit_test_dir
@@ -137,11 +149,97 @@ def run(cores, work_dir, samples, parameters, resources, slurm, dry_run, unlock,
 @cli.command('cleanup')
 @click.option('-d', '--work_dir', type = click.Path(), required = True, \
     help = 'Absolute path to working directory')
-@click.option('-s', '--samples', type = click.Path(), required = True, \
-    help = 'Sample CSV in format [sample_name,...,]')
-def cleanup(work_dir, samples): 
-    df = pd.read_csv(samples, header = 0, index_col = 0) # name, fwd, rev
-    cleanup_files(work_dir, df)
+@click.option('-s', '--samples', type = click.Path(), required = False, \
+    help = 'Only remove the intermediate files of the samples in this CSV (default: all)')
+@click.option('--dry_run', is_flag = True, default = False, \
+    help = 'Only report the disk usage of each stage and how much removing its intermediate files would free')
+@click.option('-t', '--threads', type = int, default = 8, show_default = True, \
+    help = 'Number of threads to scan and remove files with')
+def cleanup(work_dir, samples, dry_run, threads): 
+    smps = None
+    if samples:
+        import pandas as pd
+        smps = [str(s) for s in pd.read_csv(samples, header = 0, index_col = 0).index] # name, mag_dir, bam
+    cleanup_files(work_dir, smps, dry_run, threads)
+
+
+@cli.command('query')
+@click.option('-d', '--work_dir', type = click.Path(), required = True, \
+    help = 'Absolute path to working directory')
+@click.option('-q', '--quality', multiple = True, type = click.Choice(['Near_Complete', 'High', 'Medium', 'Low', 'NA']), \
+    help = 'Only MAGs of this MIMAG quality (can be repeated)')
+@click.option('--gunc_status', type = click.Choice(['Pass', 'Fail']), required = False, \
+    help = 'Only MAGs with this GUNC status')
+@click.option('-t', '--taxon', type = str, required = False, \
+    help = 'Only MAGs whose GTDB-Tk classification starts with this prefix (ex. d__Bacteria;p__Bacillota)')
+@click.option('--sample', multiple = True, \
+    help = 'Only MAGs from this sample (can be repeated)')
+@click.option('--min_completeness', type = float, required = False, \
+    help = 'Minimum CheckM2 completeness')
+@click.option('--max_contamination', type = float, required = False, \
+    help = 'Maximum CheckM2 contamination')
+@click.option('-g', '--group_by', multiple = True, \
+    help = 'Count and average the MAGs per value of this column (can be repeated)')
+@click.option('--columns', type = str, required = False, \
+    help = 'Comma-separated columns to output (default: all)')
+@click.option('-o', '--output', type = click.File('w'), default = '-', show_default = True, \
+    help = 'Output CSV')
+def query(work_dir, quality, gunc_status, taxon, sample, min_completeness, max_contamination, group_by, columns, output):
+    db = os.path.join(work_dir, 'mag_qc', 'final_reports', 'cohort.sqlite')
+    query_store(db, output, quality, gunc_status, taxon, sample, min_completeness, max_contamination, \
+                group_by, columns.split(',') if columns else None)
+
+
+@cli.command('profile')
+@click.option('-d', '--work_dir', type = click.Path(), required = True, \
+    help = 'Absolute path to working directory')
+@click.option('-r', '--resources', type = click.Path(), required = False, \
+    help = 'Absolute path to resources YAML used for the run (to compare usage against requests)')
+@click.option('-n', '--top', type = int, default = 20, show_default = True, \
+    help = 'Number of slowest jobs to list')
+@click.option('--min_use', type = float, default = 0.25, show_default = True, \
+    help = 'Flag jobs that used less than this fraction of their requested threads or memory')
+@click.option('-o', '--output', type = click.Path(), required = False, \
+    help = 'Write every job\'s measurements and requests to this TSV (or JSON, if it ends with .json)')
+@click.option('--history', type = click.Path(exists = True), multiple = True, \
+    help = 'Job TSVs exported (-o) from earlier runs to also fit the runtime model to (can be repeated)')
+@click.option('-m', '--model', type = click.Path(), required = False, \
+    help = 'Write the runtime model here (default: logs/runtime_model.json, which later runs in the working directory use)')
+def profile(work_dir, resources, top, min_use, output, history, model):
+    import yaml
+    main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # /path/to/main_dir/workflow/cli.py
+    ryaml = resources if resources else os.path.join(main_dir, 'configs', 'resources.yaml')
+    with open(ryaml, 'r') as f_in:
+        config = yaml.safe_load(f_in)
+    df = profile_jobs(work_dir, config)
+    print_profile(df, top, min_use)
+    if output and output.endswith('.json'):
+        df.to_json(output, orient = 'records', indent = 1)
+    elif output:
+        df.to_csv(output, sep = '\t', index = False, na_rep = 'NA')
+    import pandas as pd
+    hist = pd.concat([df] + [pd.read_csv(h, sep = '\t') for h in history], ignore_index = True)
+    Runtime_Model().fit(hist).save(model if model else os.path.join(work_dir, 'logs', 'runtime_model.json'))
+
+
+@cli.command('report')
+@click.option('-d', '--work_dir', type = click.Path(), required = True, \
+    help = 'Absolute path to working directory')
+@click.option('-o', '--out_dir', type = click.Path(), required = False, \
+    help = 'Directory to write the figures to (default: final_reports/figures)')
+@click.option('--source', type = click.Choice(['auto', 'store', 'csv']), default = 'auto', show_default = True, \
+    help = 'Read the MAGs from the cohort store or the per-sample summaries (auto: the store, if there is one)')
+@click.option('-b', '--bins', type = int, default = 256, show_default = True, \
+    help = 'Number of bins of each parameter\'s histograms and density grids')
+@click.option('--dpi', type = int, default = 300, show_default = True, \
+    help = 'Resolution of the figures')
+@click.option('--chunk_size', type = int, default = 100000, show_default = True, \
+    help = 'Number of MAGs to read at a time')
+def report(work_dir, out_dir, source, bins, dpi, chunk_size):
+    out_dir = out_dir if out_dir else os.path.join(work_dir, 'mag_qc', 'final_reports', 'figures')
+    rep = cohort_report(work_dir, out_dir, source, bins, dpi, chunk_size)
+    print('Wrote the figures of {} MAGs from {} samples to {}'.format( \
+        sum(st[0] for st in rep.class_stats.values()), len(rep.SAMPLES), out_dir))
 
 
 @cli.command('test')
@@ -172,6 +270,8 @@ def test():
 
 cli.add_command(run)
 cli.add_command(cleanup)
+cli.add_command(query)
+cli.add_command(profile)
 cli.add_command(test)
 
 
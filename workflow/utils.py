@@ -4,14 +4,22 @@
 # --- Workflow setup --- #
 
 
+import csv
+import fcntl
+from functools import lru_cache
 import glob
 import gzip
+import hashlib
+import json
+import math
+import mmap
 import os
 from os import makedirs, symlink
 from os.path import abspath, basename, exists, join
-import pandas as pd
 import re
 import shutil
+import sqlite3
+import sys
 import yaml
 
 def get_conda_prefix(yaml_file):
@@ -21,16 +29,78 @@ def get_conda_prefix(yaml_file):
     return config.get("conda_prefix", "Not Found")  # Default value if key is missing
 
 
-def extract_from_gzip(ap, out):
-    if open(ap, 'rb').read(2) == b'\x1f\x8b': # If the input is gzipped
-        with gzip.open(ap, 'rb') as f_in, open(out, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    else: # Otherwise, symlink
-        symlink(ap, out)
+MAGIC = {b'\x1f\x8b': 'gzip', b'\x28\xb5\x2f\xfd': 'zstd'} # bgzip's blocks are gzip members, so it reads as gzip
+
+
+def compression(fi):
+    '''The compression of a file from its magic bytes ('gzip', 'zstd'), or None if it's uncompressed.'''
+    with open(fi, 'rb') as f_in:
+        head = f_in.read(4)
+    for magic, comp in MAGIC.items():
+        if head.startswith(magic):
+            return comp
+    return None
+
+
+def decompress(src, fo, comp):
+    if comp == 'gzip':
+        with gzip.open(src, 'rb') as f_in, open(fo, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 24)
+        return
+    try: # zstandard is optional, and the zstd CLI is used without it
+        import zstandard
+    except ImportError:
+        if not shutil.which('zstd'):
+            raise RuntimeError('{} is zstd-compressed: install zstandard (pip) or zstd (conda)'.format(src))
+        import subprocess
+        subprocess.run(['zstd', '-q', '-d', '-f', src, '-o', fo], check = True)
+        return
+    with open(src, 'rb') as f_in, open(fo, 'wb') as f_out:
+        zstandard.ZstdDecompressor().copy_stream(f_in, f_out)
+
+
+def inflate(src, out, comp):
+    '''Decompress src to out, written under a temporary name and renamed into place, so that an interrupted ingest
+    never leaves a partial MAG behind. The copy takes the source's mtime, so that decompressing it again (after it
+    was released) doesn't make its rules re-run.'''
+    tmp = '{}.{}.tmp'.format(out, os.getpid())
+    decompress(src, tmp, comp)
+    st = os.stat(src)
+    os.utime(tmp, ns = (st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp, out) # Also atomically replaces a link from an older ingest
+    return getsize(out)
+
+
+def inflate_all(jobs, threads):
+    '''Decompress (source, copy, compression) jobs on a thread pool (zlib and zstd release the GIL), reporting progress.'''
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    import time
+    if not jobs:
+        return
+    start = time.perf_counter()
+    done = size = 0
+    with ThreadPoolExecutor(max_workers = max(1, threads)) as pool:
+        for f in as_completed([pool.submit(inflate, *j) for j in jobs]):
+            size += f.result()
+            done += 1
+            if done % 100 == 0 or done == len(jobs):
+                secs = time.perf_counter() - start
+                print('Decompressed {}/{} MAGs ({:.1f} MB in {:.1f} s, {:.1f} MB/s)'.format(done, len(jobs), size / 1e6, \
+                    secs, size / 1e6 / secs if secs else 0), file = sys.stderr)
+
+
+def release_inflated(tmp):
+    '''Remove the decompressed copies of compressed MAGs once the workflow has finished with them. They're decompressed
+    again, with the same mtime, if a later run needs them.'''
+    man = read_manifest(tmp)
+    for s, m in man.get('samples', {}).items():
+        for b in m.get('inflated', []):
+            if exists(join(tmp, s, b + '.fa')):
+                os.remove(join(tmp, s, b + '.fa'))
 
 
 def check_format(bin_lst):
-    camp_format = re.compile(r'^bin\.\d+\.fa$')
+    camp_format = re.compile(r'^bin\.\d+\.fa(\.gz|\.bgz|\.zst)?$')
     # Iterate through the files in the directory
     for b in bin_lst:
         if not camp_format.match(basename(b)):
@@ -38,27 +108,165 @@ def check_format(bin_lst):
     return True # All MAGs follow the CAMP naming format
 
 
-def ingest_samples(samples, tmp):
-    df = pd.read_csv(samples, header = 0, index_col = 0) # name, mag_dir, fwd, rev
-    s = list(df.index)
-    lst = df.values.tolist()
-    for i,l in enumerate(lst):
-        if not exists(join(tmp, s[i])): # Make a temporary directory for all of the MAGs in the sample
-            makedirs(join(tmp, s[i]))
-            with open(join(tmp, s[i] + '.out'), 'w') as f_out: # Enables the CheckM rule to run
-                bin_lst = glob.glob(l[0] + '/*.fa*')
-                if l[0] + '/bin.unbinned.fa' in bin_lst:
-                    bin_lst.remove(l[0] + '/bin.unbinned.fa')
-                camp_format = check_format(bin_lst)
-                for j,m in enumerate(bin_lst):
-                    prefix = basename(m).split('.')[1] if camp_format else 'bin.{}'.format(j)
-                    symlink(abspath(m), join(tmp, s[i], prefix + '.fa'))
-                    f_out.write(str(prefix) + '\n')
-                symlink(abspath(l[1]), join(tmp, s[i] + '.bam'))
+MANIFEST_VERSION = 3 # Bump whenever ingest_samples or the manifest layout changes
+
+
+def file_sha1(fi):
+    h = hashlib.sha1()
+    with open(fi, 'rb') as f_in:
+        for chunk in iter(lambda: f_in.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_manifest(fo, man):
+    with open(fo + '.tmp', 'w') as f_out:
+        json.dump(man, f_out)
+    os.replace(fo + '.tmp', fo)
+
+
+def read_manifest(tmp):
+    try:
+        with open(join(tmp, 'manifest.json'), 'r') as f_in:
+            man = json.load(f_in)
+    except (OSError, ValueError):
+        return {}
+    return man if man.get('version') == MANIFEST_VERSION else {}
+
+
+def dir_mtime(d):
+    return os.stat(d).st_mtime if exists(d) else None
+
+
+def manifest_is_current(man, samples, tmp):
+    '''Whether the samples.csv and the MAG directories are unchanged since the manifest was written.'''
+    if man.get('samples_csv') != abspath(samples):
+        return False
+    st = os.stat(samples)
+    if [man['mtime'], man['size']] != [st.st_mtime, st.st_size]:
+        # Only trust a changed mtime if the contents are the same (ex. the file was copied or touched)
+        if man['size'] != st.st_size or man['sha1'] != file_sha1(samples):
+            return False
+        man['mtime'] = st.st_mtime
+        write_manifest(join(tmp, 'manifest.json'), man)
+    for s, m in man['samples'].items():
+        # MAGs being added, removed, or replaced (moved in) changes the directory's mtime
+        if m['dir_mtime'] != dir_mtime(m['mag_dir']) or not exists(join(tmp, s + '.out')):
+            return False
+        if not all(exists(join(tmp, s, b + '.fa')) for b in m.get('inflated', [])): # Released after the last run
+            return False
+    return True
+
+
+def adopt_sample(s, tmp):
+    '''Manifest entry for a sample ingested before there was a manifest, taking its linked MAGs as they are now.'''
+    bins = {}
+    for b in [l.strip() for l in open(join(tmp, s + '.out'), 'r') if l.strip()]:
+        if not os.path.islink(join(tmp, s, b + '.fa')): # Decompressed, so ingested again from its source
+            continue
+        src = os.readlink(join(tmp, s, b + '.fa'))
+        st = os.stat(src)
+        bins[b] = [src, st.st_size, st.st_mtime]
+    return {'bins': bins}
+
+
+def relink(src, link):
+    if os.path.lexists(link):
+        os.remove(link)
+    symlink(src, link)
+
+
+def place_mag(src, link, comp, jobs):
+    '''Symlink an uncompressed MAG into the tmp tree, or queue a compressed one to be decompressed there.'''
+    if comp:
+        jobs.append((src, link, comp))
+    else:
+        relink(src, link)
+
+
+def ingest_sample(s, mag_dir, bam, tmp, old, jobs):
+    '''Link a sample's MAGs into tmp/{s} and write its MAG list, only touching the MAGs that were added, changed, or removed since the last ingest.
+
+    Compressed MAGs (gzip, bgzip, or zstd) are queued in jobs to be decompressed into tmp/{s} instead.
+    '''
+    check_make(join(tmp, s))
+    bin_lst = [m for m in glob.glob(mag_dir + '/*.fa*') if not basename(m).startswith('bin.unbinned.fa')]
+    camp_format = check_format(bin_lst)
+    old_bins = old['bins'] if old else {}
+    old_ids = {v[0]: b for b, v in old_bins.items()}
+    # MAGs that don't follow the CAMP naming format keep their IDs, and new ones are numbered after them
+    next_j = 1 + max([int(b.split('.')[1]) for b in old_bins if re.match(r'^bin\.\d+$', b)], default = -1)
+    bins = {}
+    inflated = set()
+    added = []
+    changed = []
+    for j,m in enumerate(bin_lst):
+        src = abspath(m)
+        st = os.stat(src)
+        comp = compression(src)
+        if src in old_ids:
+            b = old_ids[src]
+            link = join(tmp, s, b + '.fa')
+            if old_bins[b][1:] != [st.st_size, st.st_mtime]: # Re-linking makes the MAG's rules re-run
+                place_mag(src, link, comp, jobs)
+                changed.append(b)
+            elif comp and (os.path.islink(link) or not exists(link)): # Released, or linked by an older ingest
+                jobs.append((src, link, comp))
+        else:
+            if camp_format:
+                b = basename(m).split('.')[1]
+            elif old:
+                b = 'bin.{}'.format(next_j)
+                next_j += 1
+            else:
+                b = 'bin.{}'.format(j)
+            place_mag(src, join(tmp, s, b + '.fa'), comp, jobs)
+            added.append(b)
+        bins[b] = [src, st.st_size, st.st_mtime]
+        if comp:
+            inflated.add(b)
+    removed = [b for b in old_bins if b not in bins]
+    for b in removed:
+        if os.path.lexists(join(tmp, s, b + '.fa')):
+            os.remove(join(tmp, s, b + '.fa'))
+    # Keep the previous order, so that the MAG list (and everything downstream of it) only changes if the MAGs did
+    order = [b for b in old_bins if b in bins] + [b for b in bins if b not in old_bins]
+    bin_txt = ''.join(b + '\n' for b in order)
+    fo = join(tmp, s + '.out')
+    if not exists(fo) or open(fo, 'r').read() != bin_txt: # Enables the CheckM rule to run
+        with open(fo, 'w') as f_out:
+            f_out.write(bin_txt)
+    if not os.path.lexists(join(tmp, s + '.bam')) or os.readlink(join(tmp, s + '.bam')) != abspath(bam):
+        relink(abspath(bam), join(tmp, s + '.bam'))
+    if old and (added or changed or removed):
+        print('Re-ingested {}: {} MAGs added, {} changed, {} removed'.format(s, len(added), len(changed), len(removed)), file = sys.stderr)
+    return {'mag_dir': mag_dir, 'bam': bam, 'dir_mtime': dir_mtime(mag_dir), 'bins': {b: bins[b] for b in order}, \
+        'inflated': [b for b in order if b in inflated]}
+
+
+def ingest_samples(samples, tmp, threads = 1):
+    man = read_manifest(tmp)
+    if man and manifest_is_current(man, samples, tmp): # Nothing to do if the samples were already ingested
+        return list(man['samples'])
+    with open(samples, 'r') as f_in:
+        rows = [r for r in csv.reader(f_in) if r][1:] # name, mag_dir, bam
+    old = man.get('samples', {})
+    entries = {}
+    jobs = []
+    for r in rows:
+        s = r[0]
+        if s not in old and exists(join(tmp, s + '.out')):
+            old[s] = adopt_sample(s, tmp)
+        entries[s] = ingest_sample(s, r[1], r[2], tmp, old.get(s), jobs)
         # if not exists(join(tmp, s[i] + '_1.fastq')):
         #     extract_from_gzip(abspath(l[1]), join(tmp, s[i] + '_1.fastq'))
         #     extract_from_gzip(abspath(l[2]), join(tmp, s[i] + '_2.fastq'))
-    return s
+    inflate_all(jobs, threads) # Before the manifest, so that a failed decompression is retried next time
+    # Record what was ingested, so that later parses (incl. every cluster job's) can skip straight to the sample list
+    st = os.stat(samples)
+    write_manifest(join(tmp, 'manifest.json'), {'version': MANIFEST_VERSION, 'samples_csv': abspath(samples), \
+        'mtime': st.st_mtime, 'size': st.st_size, 'sha1': file_sha1(samples), 'samples': entries})
+    return list(entries)
 
 
 def check_make(d):
@@ -84,17 +292,11 @@ class Workflow_Dirs:
         check_make(self.TMP)
         # Add custom subdirectories to organize rule logs
         check_make(self.LOG)
-        log_dirs = ['checkm', 'gunc', 'gtdbtk', 'dnadiff', 'quast', 'prokka']
+        log_dirs = ['checkm', 'gunc', 'gtdbtk', 'dnadiff', 'quast', 'prokka', 'slurm']
         for d in log_dirs: 
             check_make(join(self.LOG, d))
 
 
-def cleanup_files(work_dir, df):
-    smps = list(df.index)
-    for s in smps: 
-        os.system('rm  ' + join(dirs.OUT, '1_cmseq', s, '*bam*'))
-
-
 def print_cmds(f):
     # fo = basename(log).split('.')[0] + '.cmds'
     # lines = open(log, 'r').read().split('\n')
@@ -120,42 +322,733 @@ def print_cmds(f):
 
 
 # from cmseq import CMSEQ_DEFAULTS, BamFile
-import numpy as np
 from os import getenv
 from os.path import getsize
 
 
 def add_bin_num(fi, bin_num, fo):
-    ctg_num = 0
-    with open(fi,'r') as f_in, open(fo, 'w') as f_out:
-        for line in f_in:
-            if line[0] == '>':
-                ctg_name = line.strip('\n').replace('>','')
-                new_ctg_name = ">%s_%i\t%s" % (bin_num, ctg_num, ctg_name) 
-                f_out.write(new_ctg_name + '\n')
-                # print(new_ctg_name)
-                ctg_num += 1
-            else:
-                f_out.write(line)
+    '''Rename each contig to {bin_num}_{i}, keeping the original header after a tab.'''
+    buf = map_fasta(fi)
+    mv = memoryview(buf)
+    with open(fo, 'wb', buffering = FASTA_BUF) as f_out:
+        for i, (start, _, end) in enumerate(fasta_records(buf)):
+            f_out.write('>{}_{}\t'.format(bin_num, i).encode())
+            f_out.write(mv[start + 1:end])
+
+
+@lru_cache(maxsize = None)
+def read_bin_nums(fi):
+    return tuple(i.strip() for i in open(fi, 'r').readlines())
 
 
 def get_bin_nums(s, d):
-    tmp = open(join(d, str(s) + '.out'), 'r').readlines()
-    # print(*[i.strip() for i in tmp])
-    return [i.strip() for i in tmp]
+    # Memoised, since every per-sample aggregation rule expands over the MAG list
+    return list(read_bin_nums(join(d, str(s) + '.out')))
+
+
+REF_SUFFIXES = {'_genomic.fna.gz': 1, '_genomic.fna': 0} # Reference FastA suffix -> compression (1 = gzip)
+
+
+def ref_acc(r_path):
+    '''The GTDB accession of a reference FastA.'''
+    name = basename(r_path)
+    for suffix in REF_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def open_ref(r_path):
+    return gzip.open(r_path, 'rb') if r_path.endswith('.gz') else open(r_path, 'rb')
+
+
+class Ref_Index:
+    '''Index of the GTDB-Tk reference genomes (skani/database/ in the GTDB-Tk database), by accession.
+
+    Each accession's path (relative to the database), size, and compression are found in one walk of the tree
+    and saved as sorted numpy arrays, one index per database release, so that later jobs (and runs) load it in
+    milliseconds and resolve a whole sample's accessions with one binary search. It's built on first use, under
+    a file lock.
+    '''
+
+    def __init__(self, gtdb_db, index_dir):
+        self.ROOT = join(abspath(gtdb_db), 'skani', 'database') if gtdb_db else ''
+        self.FILE = join(index_dir, 'gtdb_index.{}.npz'.format(hashlib.sha1(self.ROOT.encode()).hexdigest()[:16]))
+        self.arrays = None
+
+    def build(self):
+        import numpy as np
+        if not os.path.isdir(self.ROOT):
+            raise FileNotFoundError('No GTDB-Tk reference genomes in {} (check gtdb_db)'.format(self.ROOT))
+        rows = []
+        dirs = [self.ROOT]
+        while dirs:
+            with os.scandir(dirs.pop()) as it:
+                for e in it:
+                    if e.is_dir():
+                        dirs.append(e.path)
+                        continue
+                    for suffix, comp in REF_SUFFIXES.items():
+                        if e.name.endswith(suffix):
+                            rows.append((e.name[:-len(suffix)], os.path.relpath(e.path, self.ROOT), e.stat().st_size, comp))
+                            break
+        rows.sort()
+        acc, rel, size, comp = zip(*rows) if rows else ([], [], [], [])
+        tmp = '{}.{}.tmp'.format(self.FILE, os.getpid())
+        with open(tmp, 'wb') as f_out:
+            np.savez(f_out, acc = np.array(acc, dtype = 'S'), rel = np.array(rel, dtype = 'S'), \
+                size = np.array(size, dtype = np.uint64), comp = np.array(comp, dtype = np.uint8))
+        os.replace(tmp, self.FILE) # Atomic, so other jobs never load a partial index
+
+    def load(self):
+        import numpy as np
+        if self.arrays is None:
+            if not exists(self.FILE):
+                check_make(os.path.dirname(self.FILE))
+                with open(self.FILE + '.lock', 'a') as f_lock:
+                    fcntl.flock(f_lock, fcntl.LOCK_EX)
+                    if not exists(self.FILE): # Another job may have built it while this one waited
+                        self.build()
+            with np.load(self.FILE) as d:
+                self.arrays = {k: d[k] for k in d.files}
+        return self.arrays
+
+    def resolve(self, accs):
+        '''Paths and sizes of the accessions' reference genomes. Accessions not in the index get 'None' and 0.'''
+        import numpy as np
+        accs = np.asarray(accs, dtype = 'S')
+        paths = np.full(len(accs), 'None', dtype = object)
+        sizes = np.zeros(len(accs), dtype = np.uint64)
+        d = self.load()
+        if len(accs) and len(d['acc']):
+            i = np.minimum(np.searchsorted(d['acc'], accs), len(d['acc']) - 1)
+            found = d['acc'][i] == accs
+            paths[found] = [join(self.ROOT, r.decode()) for r in d['rel'][i[found]]]
+            sizes[found] = d['size'][i[found]]
+        return paths, sizes
+
+
+MAG_REFS_COLS = ['bin_num', 'acc', 'path', 'size']
+
+
+def get_mag_refs(fi, index, fo):
+    '''Look up the closest reference genome of each of a sample's MAGs (from its GTDB-Tk report) in the index, and
+    write the sample's MAG -> reference table. References missing from the database are reported here, instead of
+    becoming empty alignments hours later, and their MAGs are handled as unclassified.'''
+    import pandas as pd
+    if getsize(fi) != 0:
+        df = pd.read_csv(fi, sep = '\t', usecols = ['user_genome', 'closest_genome_reference'], dtype = str)
+        df = df.rename(columns = {'user_genome': 'bin_num', 'closest_genome_reference': 'acc'}).fillna({'acc': 'None'})
+    else:
+        df = pd.DataFrame(columns = ['bin_num', 'acc'], dtype = str)
+    df['path'], df['size'] = 'None', 0
+    classified = (df['acc'] != 'None').to_numpy()
+    if classified.any():
+        paths, sizes = index.resolve(df['acc'][classified].to_numpy())
+        df.loc[classified, 'path'] = paths
+        df.loc[classified, 'size'] = sizes.astype(int)
+    missing = df[classified & (df['path'] == 'None').to_numpy()]
+    if len(missing):
+        print('{} of {} classified MAGs have no reference genome in {}: {}'.format(len(missing), classified.sum(), \
+            index.ROOT, ', '.join(missing['bin_num'] + ' (' + missing['acc'] + ')')), file = sys.stderr)
+    df[MAG_REFS_COLS].to_csv(fo, sep = '\t', index = False)
+
+
+@lru_cache(maxsize = None)
+def read_mag_refs(fi, mtime):
+    with open(fi, 'r') as f_in:
+        next(f_in) # Header
+        return dict(l.rstrip('\n').split('\t')[:3:2] for l in f_in) # bin_num -> path
+
+
+def mag_ref(fi, b):
+    '''Path to the MAG's closest reference genome in the sample's MAG -> reference table, or 'None'.'''
+    if not exists(fi):
+        return 'None'
+    return read_mag_refs(fi, os.stat(fi).st_mtime_ns).get(str(b), 'None') # Re-read if the table is rewritten
+
+
+def split_mag_refs(fi, out_dir):
+    '''Write each MAG's row of a MAG -> reference table to its own table (out_dir/{bin_num}.tsv).
+
+    Only the rows that changed are rewritten, so that re-classifying a sample's other MAGs (ex. when MAGs are added)
+    doesn't re-run this MAG's jobs, while a MAG that was added or got a new reference does re-run them.
+    '''
+    makedirs(out_dir, exist_ok = True)
+    with open(fi, 'r') as f_in:
+        header = next(f_in)
+        for line in f_in:
+            fo = join(out_dir, line.split('\t', 1)[0] + '.tsv')
+            if not exists(fo) or open(fo, 'r').read() != header + line:
+                with open(fo, 'w') as f_out:
+                    f_out.write(header + line)
+
+
+class Ref_Store:
+    '''Shared store of decompressed reference genomes, keyed by GTDB accession.
+
+    Each reference is decompressed at most once (under a per-accession file lock, so concurrent jobs
+    wait for each other) and handed to MAGs as a hardlink, or a symlink if the store is on another
+    filesystem. When the store grows past max_gb, the least recently requested references are evicted.
+    '''
+
+    def __init__(self, store_dir, max_gb):
+        self.DIR = store_dir
+        self.MAX_BYTES = int(float(max_gb) * 1e9)
+        check_make(self.DIR)
+
+    def _lock(self, name, blocking = True):
+        f_lock = open(join(self.DIR, name + '.lock'), 'a')
+        try:
+            fcntl.flock(f_lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f_lock.close()
+            return None
+        return f_lock
+
+    def link(self, r_path, out):
+        acc = ref_acc(r_path)
+        fa = join(self.DIR, acc + '.fa')
+        f_lock = self._lock(acc)
+        try: # Hold the lock until the MAG's link exists, so the reference can't be evicted in between
+            if not exists(fa):
+                tmp = '{}.{}.tmp'.format(fa, os.getpid())
+                with open_ref(r_path) as f_in, open(tmp, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out, 1 << 24)
+                os.replace(tmp, fa) # Atomic, so readers never see a partial reference
+            try:
+                os.link(fa, out)
+            except OSError: # Cross-device
+                symlink(abspath(fa), out)
+            os.utime(f_lock.name) # The lock file's mtime records the last request (the FastA's is left alone for Snakemake)
+        finally:
+            f_lock.close()
+        self.evict(keep = acc)
+
+    def sketch(self, r_path, k, scaled):
+        '''FracMinHash sketch and length of a reference, computed once per accession and kept in the store.'''
+        import numpy as np
+        acc = ref_acc(r_path)
+        fo = join(self.DIR, 'sketches', '{}.k{}.s{}.npz'.format(acc, k, scaled))
+        if not exists(fo):
+            f_lock = self._lock(acc + '.sketch')
+            try:
+                if not exists(fo): # Another job may have sketched it while this one waited
+                    check_make(join(self.DIR, 'sketches'))
+                    with open_ref(r_path) as f_in:
+                        hashes, length = fasta_sketch(f_in.read(), k, scaled)
+                    tmp = '{}.{}.tmp'.format(fo, os.getpid())
+                    with open(tmp, 'wb') as f_out:
+                        np.savez(f_out, hashes = hashes, length = length)
+                    os.replace(tmp, fo)
+            finally:
+                f_lock.close()
+        with np.load(fo) as d:
+            return d['hashes'], int(d['length'])
+
+    def evict(self, keep = None):
+        f_lock = self._lock('.store')
+        try:
+            entries = []
+            for fa in glob.glob(join(self.DIR, '*.fa')):
+                acc = basename(fa)[:-3]
+                lock_path = join(self.DIR, acc + '.lock')
+                last_used = os.stat(lock_path).st_mtime if exists(lock_path) else 0
+                entries.append((last_used, acc, getsize(fa)))
+            total = sum(e[2] for e in entries)
+            for _, acc, size in sorted(entries):
+                if total <= self.MAX_BYTES:
+                    break
+                if acc == keep:
+                    continue
+                acc_lock = self._lock(acc, blocking = False)
+                if acc_lock is None: # Currently being decompressed or linked
+                    continue
+                try:
+                    os.remove(join(self.DIR, acc + '.fa'))
+                    total -= size
+                finally:
+                    acc_lock.close()
+        finally:
+            f_lock.close()
+
+
+def stage_ref(refs_fi, b, fo, store, screen = None):
+    '''Link the MAG's closest reference genome (if it has one) out of the reference store.
+
+    With a screen of (ANI estimate, minimum ANI, minimum MAG coverage), MAGs that don't pass get no reference
+    either, so that they skip alignment.
+    '''
+    r_path = mag_ref(refs_fi, b)
+    if exists(r_path) and (screen is None or ani_passes(*screen)):
+        store.link(r_path, fo)
+    else: # An empty reference marks an unclassified (or screened-out) MAG
+        open(fo, 'w').close()
+
+
+# --- ANI pre-screen --- #
+
+
+DIFF_ROW = '%s\t%s\t%i\t%.2f\t%i\t%.2f\t%.2f' # MAG, reference, reference length, % reference covered, MAG length, % MAG covered, ANI
+MIN_SHARED_HASHES = 2 # Contigs that share fewer hashes with the reference count as unaligned
+
+
+def kmer_hashes(seq, k, scaled):
+    '''Sorted, unique FracMinHash hashes (the hashes up to 2^64 / scaled) of a sequence's canonical k-mers (k <= 32).'''
+    import numpy as np
+    codes = np.frombuffer(FASTA_CODES, dtype = np.uint8)[np.frombuffer(seq, dtype = np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype = np.uint64)
+    bad = np.concatenate([[0], np.cumsum(codes == 4)])
+    ok = (bad[k:] - bad[:-k]) == 0 # Windows without Ns or other ambiguous bases
+    c = np.where(codes == 4, 0, codes).astype(np.uint64)
+    fwd = np.zeros(n, dtype = np.uint64)
+    rev = np.zeros(n, dtype = np.uint64)
+    for j in range(k): # Build every window's forward and reverse-complement k-mer at once, a base at a time
+        fwd = (fwd << np.uint64(2)) | c[j:j + n]
+        rev |= (np.uint64(3) - c[j:j + n]) << np.uint64(2 * j)
+    x = np.minimum(fwd, rev)[ok]
+    with np.errstate(over = 'ignore'): # splitmix64's finaliser, with uint64 wrap-around
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xbf58476d1ce4e5b9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94d049bb133111eb)
+        x ^= x >> np.uint64(31)
+    return np.unique(x[x <= np.uint64((2 ** 64 - 1) // scaled)])
+
+
+def contig_seqs(buf):
+    '''Yield the sequence of each record in a (mapped) FastA, without line breaks.'''
+    for _, hdr_end, end in fasta_records(buf):
+        yield bytes(buf[hdr_end + 1:end]).translate(None, b'\n\r')
+
+
+def fasta_sketch(buf, k, scaled):
+    import numpy as np
+    hashes = [kmer_hashes(seq, k, scaled) for seq in contig_seqs(buf)]
+    length = sum(len(seq) for seq in contig_seqs(buf))
+    return (np.unique(np.concatenate(hashes)) if hashes else np.zeros(0, dtype = np.uint64)), length
+
+
+def screen_mag(refs_fi, b, fa, store, k, scaled, fo):
+    '''Estimate the MAG's ANI to its closest reference, and how much of each the other covers, from FracMinHash sketches.
+
+    Contigs sharing at least MIN_SHARED_HASHES hashes with the reference count as aligned. The ANI is the containment of
+    the aligned contigs' k-mers in the reference to the power of 1/k, and the reference's coverage is the fraction of its
+    hashes found in the MAG, corrected for the k-mers that differ at that ANI. Written as a row of parse_dnadiff's table.
+    '''
+    import numpy as np
+    r_path = mag_ref(refs_fi, b)
+    if not exists(r_path):
+        with open(fo, 'w') as f_out:
+            f_out.write(DIFF_ROW % (abspath(fa), 'None', 0, 0, 0, 0, 0) + '\n')
+        return
+    ref_hashes, ref_len = store.sketch(r_path, k, scaled)
+    mag_len = aln_len = shared = total = 0
+    mag_hashes = []
+    for seq in contig_seqs(map_fasta(fa)):
+        hashes = kmer_hashes(seq, k, scaled)
+        mag_len += len(seq)
+        hits = int(np.isin(hashes, ref_hashes, assume_unique = True).sum())
+        if hits >= MIN_SHARED_HASHES:
+            aln_len += len(seq)
+            shared += hits
+            total += len(hashes)
+        mag_hashes.append(hashes)
+    cons = shared / total if total else 0 # Fraction of k-mers conserved in the aligned contigs
+    ref_hits = np.isin(ref_hashes, np.concatenate(mag_hashes), assume_unique = False).sum() if mag_hashes else 0
+    ref_cov = min(1, ref_hits / len(ref_hashes) / cons) if cons and len(ref_hashes) else 0
+    with open(fo, 'w') as f_out:
+        f_out.write(DIFF_ROW % (abspath(fa), r_path, ref_len, 100 * ref_cov, mag_len, 100 * aln_len / mag_len if mag_len else 0, \
+            100 * cons ** (1 / k)) + '\n')
+
+
+def ani_passes(ani_tsv, min_ani, min_af):
+    '''Whether the MAG's estimated ANI and MAG coverage are high enough to be worth aligning.'''
+    cols = open(ani_tsv, 'r').readline().rstrip('\n').split('\t')
+    return float(cols[6]) >= min_ani and float(cols[5]) >= min_af
+
+
+def hash_mag(fi):
+    '''Canonical MAG hash: independent of contig names, order, line wrapping, and case.'''
+    ctg_hashes = []
+    h = None
+    with open(fi, 'rb', buffering = 1 << 20) as f_in:
+        for line in f_in:
+            if line[:1] == b'>':
+                if h is not None:
+                    ctg_hashes.append(h.digest())
+                h = hashlib.sha256()
+            elif h is not None:
+                h.update(line.strip().upper())
+    if h is not None:
+        ctg_hashes.append(h.digest())
+    return hashlib.sha256(b''.join(sorted(ctg_hashes))).hexdigest()
+
+
+def hash_mags(s, tmp, fo):
+    with open(fo, 'w') as f_out:
+        for b in get_bin_nums(s, tmp):
+            f_out.write('{}\t{}\n'.format(b, hash_mag(join(tmp, s, b + '.fa'))))
+
+
+class Result_Cache:
+    '''Persistent per-MAG tool results, keyed by MAG sequence hash and by tool and database version.
+
+    The version is the tool, its database path, and a user-set tag (bump it after upgrading a tool).
+    Each entry is its own file, written to a temporary name and renamed into place, so concurrent
+    writers (even on a shared filesystem) never leave a partial entry behind. Table reports are cached
+    as the MAG's row (minus its name, which is the first column); an empty entry records that the tool
+    ran but reported nothing for that MAG. For Prokka, only the summary TXT and feature TSV are cached.
+    '''
+
+    def __init__(self, cache_dir, tag, dbs):
+        self.DIR = cache_dir
+        self.TAG = str(tag)
+        self.DBS = dbs # Tool -> database path
+
+    def version_dir(self, tool):
+        db = self.DBS.get(tool, '') # Database releases are installed to their own directories
+        version = '{}\t{}\t{}'.format(tool, abspath(db) if db else '', self.TAG)
+        d = join(self.DIR, tool, hashlib.sha1(version.encode()).hexdigest()[:16])
+        if not exists(join(d, 'version.txt')):
+            makedirs(d, exist_ok = True)
+            self._write(join(d, 'version.txt'), version + '\n')
+        return d
+
+    def _write(self, fo, content):
+        makedirs(os.path.dirname(fo), exist_ok = True)
+        tmp = '{}.{}.tmp'.format(fo, os.getpid())
+        with open(tmp, 'w') as f_out:
+            f_out.write(content)
+        os.replace(tmp, fo)
+
+    def lookup(self, tool, hashes, tmp, s, fo_tsv, fo_miss, entry_dir = None):
+        '''Split a sample's MAGs into cache hits and misses. Misses are symlinked into a directory for the tool.
+
+        With an entry_dir, each MAG's cache entry is also written to its own file (entry_dir/{bin_num}), only rewritten
+        if the MAG changed, for tools that run on one MAG at a time.
+        '''
+        d = self.version_dir(tool)
+        if entry_dir:
+            makedirs(entry_dir, exist_ok = True)
+        ext = '.txt' if tool == 'prokka' else '.row'
+        miss_dir = fo_miss[:-len('.miss')]
+        if exists(miss_dir):
+            shutil.rmtree(miss_dir)
+        makedirs(miss_dir)
+        num_hits = 0
+        with open(hashes, 'r') as f_in, open(fo_tsv, 'w') as f_tsv, open(fo_miss, 'w') as f_miss:
+            for line in f_in:
+                b, h = line.rstrip('\n').split('\t')
+                entry = join(d, h[:2], h)
+                hit = exists(entry + ext)
+                f_tsv.write('{}\t{}\t{}\t{}\n'.format(b, h, int(hit), entry))
+                if entry_dir and (not exists(join(entry_dir, b)) or open(join(entry_dir, b), 'r').read() != entry):
+                    with open(join(entry_dir, b), 'w') as f_entry:
+                        f_entry.write(entry)
+                if hit:
+                    num_hits += 1
+                else:
+                    symlink(abspath(join(tmp, s, b + '.fa')), join(miss_dir, b + '.fa'))
+                    f_miss.write(b + '\n')
+        return num_hits
+
+    def merge(self, tool, lookup_tsv, raw_rep, fo):
+        '''Cache the rows of the MAGs that the tool just ran on, and rebuild the sample report from all of them.'''
+        d = self.version_dir(tool)
+        header = None
+        new_rows = {}
+        if exists(raw_rep) and getsize(raw_rep) != 0:
+            with open(raw_rep, 'r') as f_in:
+                header = f_in.readline()
+                for line in f_in:
+                    name, row = line.rstrip('\n').split('\t', 1)
+                    new_rows[name] = row
+            self._write(join(d, 'header.tsv'), header)
+        elif exists(join(d, 'header.tsv')):
+            header = open(join(d, 'header.tsv'), 'r').read()
+        rows = []
+        for line in open(lookup_tsv, 'r'):
+            b, _, hit, entry = line.rstrip('\n').split('\t')
+            if hit == '1':
+                row = open(entry + '.row', 'r').read()
+            else: # An empty entry means the tool had nothing to report for this MAG
+                row = new_rows.get(b, '')
+                self._write(entry + '.row', row)
+            if row:
+                rows.append(b + '\t' + row + '\n')
+        with open(fo, 'w') as f_out:
+            if rows:
+                f_out.write(header + ''.join(rows))
+
+    def hit_report(self, tool, lookup_tsv, fo):
+        '''Write the sample report of only the cache hits, so their downstream jobs don't wait for the tool's misses.'''
+        d = self.version_dir(tool)
+        rows = []
+        for line in open(lookup_tsv, 'r'):
+            b, _, hit, entry = line.rstrip('\n').split('\t')
+            row = open(entry + '.row', 'r').read() if hit == '1' else ''
+            if row:
+                rows.append(b + '\t' + row + '\n')
+        with open(fo, 'w') as f_out:
+            if rows:
+                f_out.write(open(join(d, 'header.tsv'), 'r').read() + ''.join(rows))
+
+
+def cache_stats(lookup_tsvs, fo):
+    with open(fo, 'w') as f_out:
+        f_out.write('sample\ttool\thits\tmisses\n')
+        for fi in sorted(lookup_tsvs):
+            s, tool = basename(fi)[:-len('.tsv')].rsplit('.', 1)
+            hits = [l.split('\t')[2] for l in open(fi, 'r')]
+            f_out.write('{}\t{}\t{}\t{}\n'.format(s, tool, hits.count('1'), hits.count('0')))
+
+
+# Each rule's scaling entry and the resources config keys of its maximum threads and memory
+RULE_RESOURCES = {
+    'checkm2': ('checkm2', 'checkm_threads', 'checkm_mem_mb'),
+    'checkm_sh': ('checkm_sh', 'checkm_threads', 'checkm_mem_mb'),
+    'gunc': ('gunc', 'gunc_threads', 'gunc_mem_mb'),
+    'gtdbtk': ('gtdbtk', 'gtdbtk_threads', 'gtdbtk_mem_mb'),
+    'index_mag_bam': (None, 'checkm_threads', 'checkm_mem_mb'),
+    'calc_mag_ra': (None, 'checkm_threads', 'checkm_mem_mb'),
+    'dnadiff': ('dnadiff', None, 'dnadiff_mem_mb'),
+    'quast': ('quast', 'quast_threads', 'quast_mem_mb'),
+    'prokka': ('prokka', 'prokka_threads', 'prokka_mem_mb'),
+    'summarize_gene_cts': ('summarize_gene_cts', 'summarize_gene_cts_threads', None),
+}
+
+
+class Resource_Scaler:
+    '''Threads and memory that grow with a rule's input, as floor + per_unit * size^curve, up to the configured maximum.
+
+    Sizes are computed by functions of (wildcards, input) such as mag_mbp and num_mags below. Until a rule's input
+    exists (ex. in a dry run), its job gets the floor; Snakemake re-evaluates it once the input is ready.
+    '''
+
+    def __init__(self, config):
+        self.CONFIG = config
+        self.SCALING = config['scaling'] if config.get('scaling') else {}
+
+    def scale(self, rule, res, size):
+        key, max_threads, max_mem_mb = RULE_RESOURCES[rule]
+        max_key = max_threads if res == 'threads' else max_mem_mb
+        if not max_key: # Single-threaded, or no memory declared
+            return 1 if res == 'threads' else None
+        ceiling = self.CONFIG[max_key]
+        s = self.SCALING.get(key)
+        if not s: # Not scaled, so always the maximum
+            return ceiling
+        val = s['min_' + res] + s[res + '_per_unit'] * size ** s.get('curve', 1)
+        return max(1, min(int(ceiling), int(math.ceil(val))))
+
+    def threads(self, rule, size_fn):
+        def get_threads(wildcards, input):
+            return self.scale(rule, 'threads', size_fn(wildcards, input))
+        return get_threads
+
+    def mem_mb(self, rule, size_fn):
+        def get_mem_mb(wildcards, input):
+            return self.scale(rule, 'mem_mb', size_fn(wildcards, input))
+        return get_mem_mb
+
+
+def mag_mbp(wildcards, input):
+    '''Size of a per-MAG rule's MAG FastA (Mbp, roughly).'''
+    return getsize(input.fa) / 1e6 if exists(input.fa) else 0
+
+
+def num_mags(wildcards, input):
+    '''Number of MAGs in a sample-level rule's MAG list.'''
+    if not exists(input[0]):
+        return 0
+    with open(input[0], 'r') as f_in:
+        return sum(1 for l in f_in if l.strip())
+
+
+def group_mbp(wildcards, input):
+    '''Summed size of the MAGs aligned to one reference (Mbp, roughly).'''
+    if not exists(input.grp):
+        return 0
+    with open(input.grp, 'r') as f_in:
+        return sum(getsize(l.split('\t')[2]) for l in f_in if l.strip()) / 1e6
+
+
+def parse_dry_run(f):
+    '''The rule, wildcards, threads, and memory of each job in Snakemake's dry run output.'''
+    jobs = []
+    job = None
+    for l in f.split('\n'):
+        l = l.strip()
+        if l.startswith('rule ') or l.startswith('checkpoint ') or l.startswith('localrule '):
+            job = {'rule': l.split()[-1].rstrip(':'), 'wildcards': '', 'threads': '1', 'mem_mb': ''}
+            jobs.append(job)
+        elif job and l.startswith('wildcards: '):
+            job['wildcards'] = l.replace('wildcards: ', '')
+        elif job and l.startswith('threads: '):
+            job['threads'] = l.replace('threads: ', '')
+        elif job and l.startswith('resources: '):
+            for r in l.replace('resources: ', '').split(', '):
+                if r.startswith('mem_mb='):
+                    job['mem_mb'] = r.split('=')[1]
+    return jobs
+
+
+def print_resources(f):
+    '''Print the threads and memory of each job in Snakemake's dry run output as a table.'''
+    jobs = parse_dry_run(f)
+    if not jobs:
+        return
+    widths = [max(len(c), *(len(j[c]) for j in jobs)) for c in ['rule', 'threads', 'mem_mb']]
+    print('{:<{w[0]}}  {:>{w[1]}}  {:>{w[2]}}  {}'.format('rule', 'threads', 'mem_mb', 'wildcards', w = widths))
+    for j in jobs:
+        print('{:<{w[0]}}  {:>{w[1]}}  {:>{w[2]}}  {}'.format(j['rule'], j['threads'], j['mem_mb'], j['wildcards'], w = widths))
+
+
+def shard_mags(bin_lst, bin_dir, out_dir, shard_size):
+    '''Split a sample's MAGs into directories of at most shard_size MAGs, each listed in {shard}.out.'''
+    bins = [l.strip() for l in open(bin_lst, 'r') if l.strip()]
+    check_make(out_dir)
+    for i in range(0, len(bins), shard_size):
+        shard = str(i // shard_size)
+        check_make(join(out_dir, shard))
+        with open(join(out_dir, shard + '.out'), 'w') as f_out:
+            for b in bins[i:i + shard_size]:
+                symlink(abspath(join(bin_dir, b + '.fa')), join(out_dir, shard, b + '.fa'))
+                f_out.write(b + '\n')
+
+
+def merge_tables(fi_lst, fo):
+    '''Concatenate TSV reports that share a header, skipping empty ones.'''
+    header = None
+    with open(fo, 'w') as f_out:
+        for fi in fi_lst:
+            if getsize(fi) == 0:
+                continue
+            with open(fi, 'r') as f_in:
+                h = f_in.readline()
+                if header is None:
+                    header = h
+                    f_out.write(h)
+                shutil.copyfileobj(f_in, f_out)
+
+
+def concat_files(fi_lst, fo):
+    '''Concatenate reports without a header (ex. per-MAG rows).'''
+    with open(fo, 'w') as f_out:
+        for fi in fi_lst:
+            with open(fi, 'r') as f_in:
+                shutil.copyfileobj(f_in, f_out)
+
+
+CACHED_PART = 'cached' # The part of a sample's MAGs whose GTDB-Tk results were cached
 
 
-def pair_mag_refs(row, out_dir, gtdb_db):
-    r = row['closest_genome_reference']
-    r_path = 'None'
-    if str(r) != 'nan':
-        parts = r.split('_')
-        r_path = join(gtdb_db, 'skani/database', parts[0], parts[1][0:3], parts[1][3:6], parts[1][6:9], r + '_genomic.fna.gz')
-    with open(join(out_dir, str(row['user_genome']) + '.ref'), 'w') as f_out:
-        f_out.write(r_path + '\n')
+def ref_parts(shard_dir, lookup_tsv):
+    '''Split a sample's MAGs into the parts that GTDB-Tk results arrive in: the cache hits, then each shard of misses.
 
+    Returns ({part: MAG IDs}, {MAG ID: part}), re-read whenever the shards are rewritten.
+    '''
+    return read_ref_parts(shard_dir, lookup_tsv, os.stat(shard_dir).st_mtime_ns)
 
-def parse_dnadiff(fi, fo):
+
+@lru_cache(maxsize = None)
+def read_ref_parts(shard_dir, lookup_tsv, mtime):
+    parts = {CACHED_PART: [l.split('\t', 1)[0] for l in open(lookup_tsv, 'r') if l.split('\t')[2] == '1']}
+    for fi in sorted(glob.glob(join(shard_dir, '*.out')), key = lambda f: int(basename(f)[:-len('.out')])):
+        parts[basename(fi)[:-len('.out')]] = [l.strip() for l in open(fi, 'r') if l.strip()]
+    return parts, {b: part for part, bins in parts.items() for b in bins}
+
+
+def cohort_batches(samples, bin_lsts, bin_dirs, out_dir, batch_size):
+    '''Pool the MAGs of all samples (prefixed with their sample name) into batches of at most batch_size MAGs.
+
+    Each batch gets a directory of MAG symlinks and a {batch}.out table of prefixed name, sample, and MAG ID.
+    '''
+    mags = []
+    for s, bin_lst, bin_dir in zip(samples, bin_lsts, bin_dirs):
+        for b in [l.strip() for l in open(bin_lst, 'r') if l.strip()]:
+            mags.append(('{}__{}'.format(s, b), s, b, abspath(join(bin_dir, b + '.fa'))))
+    check_make(out_dir)
+    for i in range(0, len(mags), batch_size):
+        batch = str(i // batch_size)
+        check_make(join(out_dir, batch))
+        with open(join(out_dir, batch + '.out'), 'w') as f_out:
+            for m, s, b, fa in mags[i:i + batch_size]:
+                symlink(fa, join(out_dir, batch, m + '.fa'))
+                f_out.write('{}\t{}\t{}\n'.format(m, s, b))
+
+
+def demux_tables(fi_lst, batch_lsts, s, fo):
+    '''Pull one sample's rows (renamed back to their MAG IDs) out of the cohort batch reports.'''
+    header = None
+    with open(fo, 'w') as f_out:
+        for fi, batch_lst in zip(fi_lst, batch_lsts):
+            mags = {}
+            for l in open(batch_lst, 'r'):
+                m, ms, b = l.rstrip('\n').split('\t')
+                if ms == s:
+                    mags[m] = b
+            if not mags or getsize(fi) == 0:
+                continue
+            with open(fi, 'r') as f_in:
+                h = f_in.readline()
+                if header is None:
+                    header = h
+                    f_out.write(h)
+                for line in f_in:
+                    m, row = line.split('\t', 1)
+                    if m in mags:
+                        f_out.write(mags[m] + '\t' + row)
+
+
+def group_mag_refs(samples, tmp, out_dir, grp_dir, screen = None):
+    '''Group the MAGs of all samples by their closest reference genome, so each reference is aligned to once.
+
+    With a screen of (minimum ANI, minimum MAG coverage), MAGs whose pre-screen estimates don't pass join the
+    unaligned 'None' group.
+    '''
+    check_make(grp_dir)
+    groups = {}
+    with open(join(grp_dir, 'members.tsv'), 'w') as f_mem:
+        for s in samples:
+            for b in get_bin_nums(s, tmp):
+                r_path = mag_ref(join(out_dir, '4_dnadiff', s, 'mag_refs.tsv'), b)
+                if screen and not ani_passes(join(out_dir, '4_dnadiff', s, b + '.ani.tsv'), *screen):
+                    r_path = 'None'
+                acc = ref_acc(r_path) if exists(r_path) else 'None'
+                groups.setdefault(acc, []).append('\t'.join([s, b, abspath(join(tmp, s, b + '.fa')), \
+                    join(out_dir, '4_dnadiff', s, b + '.ref.fa'), join(out_dir, '4_dnadiff', s, b), join(out_dir, '5_quast', s, b)]))
+                f_mem.write('{}\t{}\t{}\n'.format(s, b, acc))
+    for acc, lst in groups.items(): # sample, bin_num, MAG FastA, staged reference, dnadiff prefix, QUAST directory
+        with open(join(grp_dir, acc + '.tsv'), 'w') as f_out:
+            f_out.write('\n'.join(lst) + '\n')
+
+
+def get_ref_group(grp_dir, s, b):
+    return load_ref_groups(join(grp_dir, 'members.tsv'))[(str(s), str(b))]
+
+
+@lru_cache(maxsize = 1)
+def load_ref_groups(fi):
+    ref_groups = {}
+    with open(fi, 'r') as f_in:
+        for line in f_in:
+            s, b, acc = line.rstrip('\n').split('\t')
+            ref_groups[(s, b)] = acc
+    return ref_groups
+
+
+def group_members(fi):
+    return [l.split('\t')[:2] for l in open(fi, 'r').read().splitlines()]
+
+
+def parse_dnadiff(fi, fo, ani = None):
+    if ani and (not exists(fi) or getsize(fi) == 0): # Not aligned, so report the pre-screen's estimates
+        shutil.copyfile(ani, fo)
+        return
     if getsize(fi) != 0: # If the MAG was classified as a species
         first_line = open(fi, 'r').readlines()[0].split()
         ref = first_line[0]
@@ -173,7 +1066,7 @@ def parse_dnadiff(fi, fo):
                 if "AvgIdentity" in line:
                     cols = line.strip().split()
                     ident = float(cols[1])
-            output = "%s\t%s\t%i\t%.2f\t%i\t%.2f\t%.2f" % (quer, ref, lenref, float(aliref), lenquer, float(alique), float(ident))
+            output = DIFF_ROW % (quer, ref, lenref, float(aliref), lenquer, float(alique), float(ident))
     else:
         quer = fi.split('/')[-1].replace('.fa', '')
         output = quer + '\tNone\t0\t0.00\t0\t0.00\t0.00'
@@ -181,33 +1074,909 @@ def parse_dnadiff(fi, fo):
         f_out.write(output + '\n')
 
 
-def aggregate_quast(fi_lst, fo):
-    df_lst = []
+QUAST_FIELDS = {'Assembly': 'mag', '# contigs': 'num_ctgs', 'Total length': 'size', 'Genome fraction (%)': 'genome_fraction', \
+    'NG50': 'NG50', 'NA50': 'NA50', '# misassemblies': 'num_misassemb', '# misassembled contigs': 'num_misassemb_ctgs', \
+    'Misassembled contigs length': 'misassemb_ctg_len', '# unaligned contigs': 'num_unaln_ctgs', 'Unaligned length': 'unaln_len'}
+QUAST_SUMM_COLS = ['mag', 'genome_fraction', 'NG50', 'NA50', 'num_misassemb', 'prop_misassemb_ctgs', 'prop_misassemb_len', 'prop_unaln_ctgs', 'prop_unaln_len']
+
+
+def aggregate_quast(fi_lst, fo, unclassified = True):
+    '''Join the MAGs' QUAST reports into the sample's table, with zero rows for the unclassified MAGs (empty reports).
+
+    Without unclassified, only the classified MAGs' rows are written, for a part of the sample's MAGs (see merge_quast_parts).
+    '''
+    rows = []
     unc_mags = []
     for fi in fi_lst:
         if getsize(fi) != 0:
-            df_lst.append(pd.read_csv(fi, index_col = 0, sep = '\t').transpose())
+            with open(fi, 'r') as f_in: # One 'field\tvalue' line per statistic
+                fields = dict(l.rstrip('\n').split('\t', 1) for l in f_in if '\t' in l)
+            missing = [f for f in QUAST_FIELDS if f not in fields]
+            if missing:
+                raise ValueError('{} is missing the QUAST field(s) {}'.format(fi, ', '.join(missing)))
+            rows.append([fields[f] for f in QUAST_FIELDS])
         else: # If QUAST report is empty, then no classification
             unc_mags.append(fi.split('/')[-2])
-    if len(df_lst):
-        raw_df = pd.concat(df_lst)
-        raw_df.reset_index(level = 0, inplace = True)
-        df = raw_df[['index', '# contigs', 'Total length', 'Genome fraction (%)', 'NG50', 'NA50', '# misassemblies', '# misassembled contigs', 'Misassembled contigs length', '# unaligned contigs', 'Unaligned length']]
-        col_names = ['mag', 'num_ctgs', 'size', 'genome_fraction', 'NG50', 'NA50', 'num_misassemb', 'num_misassemb_ctgs', 'misassemb_ctg_len', 'num_unaln_ctgs', 'unaln_len']
-        df.columns = col_names
-        df['prop_misassemb_ctgs'] = df.apply(lambda row : float(row['num_misassemb_ctgs'])/float(row['num_ctgs']), axis = 1) 
-        df['prop_misassemb_len'] = df.apply(lambda row : float(row['misassemb_ctg_len'])/float(row['size']), axis = 1) 
-        df['prop_unaln_ctgs'] = df.apply(lambda row : float(row['num_unaln_ctgs'].split()[0])/float(row['num_ctgs']), axis = 1) 
-        df['prop_part_unaln_ctgs'] = df.apply(lambda row : float(row['num_unaln_ctgs'].split()[2])/float(row['num_ctgs']), axis = 1) 
-        df['prop_unaln_len'] = df.apply(lambda row : float(row['unaln_len'])/float(row['size']), axis = 1) 
-        for m in unc_mags: 
-            unc_mag_row  = {} # Create empty rows for unclassified MAGs
-            for c in col_names + ['prop_misassemb_ctgs', 'prop_misassemb_len', 'prop_unaln_ctgs', 'prop_unaln_len']:
-                unc_mag_row[c] = 0
-            unc_mag_row['mag'] = m
-            df = df.append(unc_mag_row, ignore_index = True)
-        fin_df = df[['mag', 'genome_fraction', 'NG50', 'NA50', 'num_misassemb', 'prop_misassemb_ctgs', 'prop_misassemb_len', 'prop_unaln_ctgs', 'prop_unaln_len']]
+    if len(rows):
+        import pandas as pd # Only needed here, so kept out of the Snakefile's parse path
+        df = pd.DataFrame(rows, columns = list(QUAST_FIELDS.values()))
+        unaln_ctgs = df['num_unaln_ctgs'].str.split(expand = True) # 'X + Y part'
+        df['num_unaln_ctgs'] = unaln_ctgs[0]
+        for c in QUAST_FIELDS.values():
+            if c != 'mag': # Missing statistics ('-') become NA
+                df[c] = pd.to_numeric(df[c], errors = 'coerce')
+        for c in ['NG50', 'NA50', 'num_misassemb']:
+            df[c] = df[c].astype('Int64')
+        df['prop_misassemb_ctgs'] = df['num_misassemb_ctgs'] / df['num_ctgs']
+        df['prop_misassemb_len'] = df['misassemb_ctg_len'] / df['size']
+        df['prop_unaln_ctgs'] = df['num_unaln_ctgs'] / df['num_ctgs']
+        df['prop_unaln_len'] = df['unaln_len'] / df['size']
+        # Create empty rows for unclassified MAGs
+        unc_df = pd.DataFrame(0, index = range(len(unc_mags)), columns = QUAST_SUMM_COLS)
+        unc_df['mag'] = unc_mags
+        fin_df = pd.concat([df[QUAST_SUMM_COLS], unc_df], ignore_index = True) if unc_mags and unclassified else df[QUAST_SUMM_COLS]
         fin_df.to_csv(fo, header = True, index = False)
     else:
         open(str(fo), 'w').close()
 
+
+def merge_quast_parts(part_lst, fi_lst, fo):
+    '''Join the parts' QUAST tables, then add the zero rows of the sample's unclassified MAGs, as aggregate_quast does.
+
+    The unclassified MAGs are only added to the sample's table, so that its rows don't depend on which MAGs share a part.
+    '''
+    merge_tables(part_lst, fo)
+    if getsize(fo) != 0: # At least one MAG was classified
+        with open(fo, 'a') as f_out:
+            for fi in fi_lst:
+                if getsize(fi) == 0:
+                    f_out.write(','.join([fi.split('/')[-2]] + ['0'] * (len(QUAST_SUMM_COLS) - 1)) + '\n')
+
+
+# --- FASTA --- #
+
+
+FASTA_BUF = 1 << 24 # Write buffer (bytes)
+MAX_HEADER_LEN = 37 # Prokka's limit on contig headers (incl. the '>')
+FASTA_CODES = bytes(b'ACGTacgt'.index(c) % 4 if c in b'ACGTacgt' else 4 for c in range(256)) # 2-bit bases, 4 for the rest
+
+
+def map_fasta(fi):
+    '''Memory-map a FastA, so records are found and counted by C-level searches over the file.'''
+    with open(fi, 'rb') as f_in:
+        if os.fstat(f_in.fileno()).st_size == 0: # Can't map an empty file
+            return b''
+        return mmap.mmap(f_in.fileno(), 0, access = mmap.ACCESS_READ)
+
+
+def fasta_records(buf):
+    '''Offsets of each record's '>', the end of its header line, and its end (after its last newline).'''
+    records = []
+    start = buf.find(b'>')
+    while start != -1:
+        hdr_end = buf.find(b'\n', start)
+        if hdr_end == -1:
+            hdr_end = len(buf)
+        # A single-byte search is a memchr over the map, much faster than searching for '\n>'
+        nxt = buf.find(b'>', hdr_end)
+        while nxt != -1 and buf[nxt - 1] != ord('\n'):
+            nxt = buf.find(b'>', nxt + 1)
+        records.append((start, hdr_end, len(buf) if nxt == -1 else nxt))
+        start = nxt
+    return records
+
+
+def contig_stats(fi):
+    '''Name, length, GC count, and N count of each contig in a FastA, from one count of each byte per contig.'''
+    import numpy as np
+    buf = map_fasta(fi)
+    arr = np.frombuffer(buf, dtype = np.uint8)
+    stats = []
+    for start, hdr_end, end in fasta_records(buf):
+        name = buf[start + 1:hdr_end].split(maxsplit = 1)
+        c = np.bincount(arr[hdr_end + 1:end], minlength = 256)
+        length = int(end - hdr_end - 1 - c[ord('\n')] - c[ord('\r')]) if end > hdr_end else 0
+        gc = int(c[ord('G')] + c[ord('C')] + c[ord('g')] + c[ord('c')])
+        stats.append((name[0].decode() if name else '', length, gc, int(c[ord('N')] + c[ord('n')])))
+    return stats
+
+
+def nx50(lengths, genome_size = None):
+    '''N50 of contig lengths, or NG50 if given the (reference) genome size (0 if the contigs cover less than half).'''
+    half = (genome_size if genome_size else sum(lengths)) / 2
+    total = 0
+    for l in sorted(lengths, reverse = True):
+        total += l
+        if total >= half:
+            return l
+    return 0
+
+
+def sanitize_fasta(fi, fo, max_len = MAX_HEADER_LEN):
+    '''Truncate headers longer than max_len, or symlink the FastA if there are none. Returns whether it was rewritten.'''
+    buf = map_fasta(fi)
+    cuts = [(start + max_len, hdr_end) for start, hdr_end, _ in fasta_records(buf) if hdr_end - start > max_len]
+    if exists(fo) or os.path.islink(fo):
+        os.remove(fo)
+    if not cuts:
+        symlink(abspath(fi), fo)
+        return False
+    # Copy everything between the cut headers' overflows in as few writes as possible
+    mv = memoryview(buf)
+    with open(fo, 'wb', buffering = FASTA_BUF) as f_out:
+        prev = 0
+        for cut, hdr_end in cuts:
+            f_out.write(mv[prev:cut])
+            prev = hdr_end
+        f_out.write(mv[prev:])
+    return True
+
+
+def contig_table(s, tmp, f_ctgs, f_mags):
+    '''Write the length, GC, and Ns of each contig of a sample's MAGs, and each MAG's contig count, size, GC, and N50.'''
+    with open(f_ctgs, 'w') as f_c, open(f_mags, 'w') as f_m:
+        f_c.write('mag\tcontig\tlength\tGC\tnum_N\n')
+        f_m.write('mag\tnum_contigs\tsize\tGC\tN50\tlongest_contig\n')
+        for b in get_bin_nums(s, tmp):
+            stats = contig_stats(join(tmp, s, b + '.fa'))
+            for name, length, gc, n in stats:
+                f_c.write('{}\t{}\t{}\t{:.4f}\t{}\n'.format(b, name, length, gc / length if length else 0, n))
+            lengths = [x[1] for x in stats]
+            size = sum(lengths)
+            f_m.write('{}\t{}\t{}\t{:.4f}\t{}\t{}\n'.format(b, len(stats), size, \
+                sum(x[2] for x in stats) / size if size else 0, nx50(lengths), max(lengths, default = 0)))
+
+
+# --- Cohort results store --- #
+
+
+# Typed schema of the per-sample summaries (final_reports/{sample}.summary.csv)
+SUMMARY_SCHEMA = [('mag', 'TEXT'), ('completeness', 'REAL'), ('contamination', 'REAL'), ('N50', 'INTEGER'), ('size', 'INTEGER'), \
+    ('GC', 'REAL'), ('clade_separation_score', 'REAL'), ('n_effective_surplus_clades', 'REAL'), ('strain_het', 'REAL'), \
+    ('num_cds', 'INTEGER'), ('num_trna', 'INTEGER'), ('num_rrna_total', 'INTEGER'), ('num_rrna_5s', 'INTEGER'), \
+    ('num_rrna_16s', 'INTEGER'), ('num_rrna_23s', 'INTEGER'), ('avg_mag_ra', 'REAL'), ('classification', 'TEXT'), \
+    ('bin_cov', 'REAL'), ('ref_cov', 'REAL'), ('ANI', 'REAL'), ('genome_fraction', 'REAL'), ('NG50', 'INTEGER'), \
+    ('NA50', 'INTEGER'), ('num_misassemb', 'INTEGER'), ('prop_misassemb_ctgs', 'REAL'), ('prop_misassemb_len', 'REAL'), \
+    ('prop_unaln_ctgs', 'REAL'), ('prop_unaln_len', 'REAL'), ('MIMAG_Quality', 'TEXT'), ('GUNC_Status', 'TEXT'), \
+    ('Overall_Score', 'REAL')]
+STORE_INDEXES = ['MIMAG_Quality', 'GUNC_Status', 'classification']
+
+
+def to_sql_value(v, t):
+    if v == '':
+        return None
+    if t == 'TEXT': # 'NA' is a category here (ex. MIMAG_Quality), not a missing value
+        return v
+    try: # Missing numbers ('NA', '-') are NULL, so that they're excluded from comparisons and averages
+        return float(v) if t == 'REAL' else int(float(v))
+    except ValueError:
+        return None
+
+
+def open_store(db):
+    con = sqlite3.connect(db, timeout = 600)
+    con.execute('CREATE TABLE IF NOT EXISTS summary (sample TEXT NOT NULL, {}, PRIMARY KEY (sample, mag))'.format( \
+        ', '.join('"{}" {}'.format(c, t) for c, t in SUMMARY_SCHEMA)))
+    con.execute('CREATE TABLE IF NOT EXISTS samples (sample TEXT PRIMARY KEY, mtime REAL, num_mags INTEGER)')
+    for c in STORE_INDEXES:
+        con.execute('CREATE INDEX IF NOT EXISTS "idx_{0}" ON summary ("{0}")'.format(c))
+    return con
+
+
+def store_summaries(db, samples, fi_lst):
+    '''Load new or updated per-sample summaries into the cohort store (an indexed SQLite file), replacing their old rows.'''
+    con = open_store(db)
+    loaded = dict(con.execute('SELECT sample, mtime FROM samples'))
+    insert = 'INSERT INTO summary VALUES ({})'.format(', '.join(['?'] * (len(SUMMARY_SCHEMA) + 1)))
+    num_loaded = 0
+    for s, fi in zip(samples, fi_lst):
+        mtime = os.stat(fi).st_mtime
+        if loaded.get(s) == mtime: # Unchanged since it was last loaded
+            continue
+        with open(fi, 'r') as f_in:
+            reader = csv.reader(f_in)
+            header = next(reader, [])
+            missing = [c for c, _ in SUMMARY_SCHEMA if c not in header]
+            if missing:
+                raise ValueError('{} is missing the column(s) {}'.format(fi, ', '.join(missing)))
+            cols = [(header.index(c), t) for c, t in SUMMARY_SCHEMA]
+            rows = [[s] + [to_sql_value(r[i], t) for i, t in cols] for r in reader]
+        with con: # Each sample is swapped in as one transaction
+            con.execute('DELETE FROM summary WHERE sample = ?', (s,))
+            con.executemany(insert, rows)
+            con.execute('INSERT OR REPLACE INTO samples VALUES (?, ?, ?)', (s, mtime, len(rows)))
+        num_loaded += 1
+    con.close()
+    return num_loaded
+
+
+def query_store(db, f_out, quality = (), gunc_status = None, taxon = None, samples = (), min_completeness = None, \
+    max_contamination = None, group_by = (), columns = None):
+    '''Write the MAGs in the cohort store that pass the filters (or per-group counts and averages) as CSV, one row at a time.'''
+    if not exists(db):
+        raise FileNotFoundError('No cohort store at {}. Has the workflow finished?'.format(db))
+    known = ['sample'] + [c for c, _ in SUMMARY_SCHEMA]
+    bad = [c for c in list(group_by) + (columns or []) if c not in known]
+    if bad:
+        raise ValueError('Unknown column(s) {} (choose from: {})'.format(', '.join(bad), ', '.join(known)))
+    conds = []
+    args = []
+    if quality:
+        conds.append('MIMAG_Quality IN ({})'.format(', '.join(['?'] * len(quality))))
+        args += list(quality)
+    if gunc_status:
+        conds.append('GUNC_Status = ?')
+        args.append(gunc_status)
+    if taxon: # A taxonomy prefix, ex. d__Bacteria;p__Firmicutes
+        conds.append("classification LIKE ? ESCAPE '\\'")
+        args.append(taxon.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    if samples:
+        conds.append('sample IN ({})'.format(', '.join(['?'] * len(samples))))
+        args += list(samples)
+    if min_completeness is not None:
+        conds.append('completeness >= ?')
+        args.append(min_completeness)
+    if max_contamination is not None:
+        conds.append('contamination <= ?')
+        args.append(max_contamination)
+    where = ' WHERE ' + ' AND '.join(conds) if conds else ''
+    if group_by:
+        grp = ', '.join('"{}"'.format(c) for c in group_by)
+        sql = 'SELECT {0}, COUNT(*) AS num_mags, AVG(completeness) AS mean_completeness, AVG(contamination) AS mean_contamination, ' \
+            'AVG(Overall_Score) AS mean_overall_score, SUM(avg_mag_ra) AS total_mag_ra FROM summary{1} GROUP BY {0} ORDER BY {0}'.format(grp, where)
+    else:
+        sql = 'SELECT {} FROM summary{} ORDER BY sample, mag'.format(', '.join('"{}"'.format(c) for c in (columns or known)), where)
+    con = sqlite3.connect(db)
+    con.execute('PRAGMA case_sensitive_like = ON') # Lets the taxonomy prefix use the classification index
+    cur = con.execute(sql, args)
+    writer = csv.writer(f_out)
+    writer.writerow([d[0] for d in cur.description])
+    for r in cur:
+        writer.writerow(['' if v is None else v for v in r])
+    con.close()
+
+
+# --- Cohort report --- #
+
+
+# Box-plotted parameters of the summary statistics figure, as (column, label)
+REPORT_PARAMS = [('completeness', 'Completeness'), ('contamination', 'Contamination'), \
+    ('clade_separation_score', 'Clade Sep. Score'), ('strain_het', 'Strain Heterogeneity'), ('avg_mag_ra', 'Rel. Abundance'), \
+    ('bin_cov', 'Coverage by Ref. (%)'), ('ANI', 'ANI'), ('GC', 'GC'), ('N50', 'N50 (bp)'), ('size', 'MAG Size (bp)'), \
+    ('genome_fraction', 'Genome Fraction (%)'), ('NG50', 'NG50'), ('NA50', 'NA50'), \
+    ('prop_misassemb_ctgs', 'Prop. Misassemb. Contigs'), ('prop_misassemb_len', 'Prop. Misassemb. Len. (bp)'), \
+    ('prop_unaln_ctgs', 'Prop. Unaligned Contigs'), ('prop_unaln_len', 'Prop. Unaligned Len. (bp)'), \
+    ('Overall_Score', 'Overall Score')]
+# Proxy statistics vs. the reference-based statistics they estimate (for species-level MAGs), as (x, y, x label, y label)
+REPORT_PAIRS = [('completeness', 'genome_fraction', 'Completeness', 'Genome Fraction'), \
+    ('contamination', 'prop_unaln_len', 'Contamination', 'Prop. Unaligned Len.'), \
+    ('clade_separation_score', 'prop_unaln_len', 'Clade Sep. Score', 'Prop. Unaligned Len.'), \
+    ('strain_het', 'prop_unaln_len', 'Strain Heterogeneity', 'Prop. Unaligned Len.'), \
+    ('bin_cov', 'ref_cov', 'MAG Cov. (%)', 'Reference Cov. (%)')]
+REF_BASED_PARAMS = ['bin_cov', 'ANI', 'genome_fraction', 'NG50', 'NA50', 'prop_misassemb_ctgs', 'prop_misassemb_len', \
+    'prop_unaln_ctgs', 'prop_unaln_len'] # Unclassified MAGs have none, which count as 0
+REPORT_CATEGORIES = {'MIMAG_Quality': ['Near_Complete', 'High', 'Medium', 'Low', 'NA'], 'GUNC_Status': ['Pass', 'Fail']}
+REPORT_COLS = sorted(set([p for p, _ in REPORT_PARAMS] + [c for x, y, _, _ in REPORT_PAIRS for c in (x, y)] + \
+    list(REPORT_CATEGORIES) + ['classification']))
+
+
+def summary_chunks(work_dir, source = 'auto', chunk_size = 100000):
+    '''Yield the report's columns of every MAG in the cohort, as data frames of at most chunk_size MAGs.
+
+    They're read from the cohort store (final_reports/cohort.sqlite) or, with source 'csv' or without a store, from
+    the per-sample summaries, so that only chunk_size MAGs are ever in memory.
+    '''
+    import pandas as pd
+    rep_dir = join(work_dir, 'mag_qc', 'final_reports')
+    db = join(rep_dir, 'cohort.sqlite')
+    if source == 'store' or (source == 'auto' and exists(db)):
+        if not exists(db):
+            raise FileNotFoundError('No cohort store at {}. Has the workflow finished?'.format(db))
+        con = sqlite3.connect(db)
+        sql = 'SELECT sample, {} FROM summary ORDER BY sample'.format(', '.join('"{}"'.format(c) for c in REPORT_COLS))
+        chunks = pd.read_sql_query(sql, con, chunksize = chunk_size)
+    else:
+        fi_lst = sorted(glob.glob(join(rep_dir, '*.summary.csv')))
+        if not fi_lst:
+            raise FileNotFoundError('No sample summaries in {}. Has the workflow finished?'.format(rep_dir))
+        chunks = (df.assign(sample = basename(fi)[:-len('.summary.csv')]) for fi in fi_lst \
+            for df in pd.read_csv(fi, usecols = REPORT_COLS, dtype = {'classification': str}, chunksize = chunk_size))
+    for df in chunks:
+        for c in REPORT_COLS:
+            if c not in REPORT_CATEGORIES and c != 'classification': # Missing statistics ('NA', '-') are NaN
+                df[c] = pd.to_numeric(df[c], errors = 'coerce')
+        df[REF_BASED_PARAMS] = df[REF_BASED_PARAMS].fillna(0)
+        for c in REPORT_CATEGORIES:
+            df[c] = df[c].fillna('NA').astype(str)
+        df['species'] = df['classification'].fillna('').str.split(';').str[6].fillna('').str.replace('s__', '').str.strip()
+        yield df
+    if source != 'csv' and exists(db):
+        con.close()
+
+
+class Cohort_Report:
+    '''Binned summaries of the cohort's MAGs, from which the report's figures are drawn.
+
+    Each parameter gets a histogram per sample (its box plots are drawn from their quantiles), and each pair of proxy
+    and reference-based statistics a 2-D density grid and the running sums of its Pearson correlation. MAGs are added a
+    chunk at a time, so memory depends on the numbers of samples and bins, not of MAGs. The bins span each column's
+    range, found by a first pass over the chunks.
+    '''
+
+    def __init__(self, samples, ranges, bins = 256):
+        import numpy as np
+        self.SAMPLES = samples
+        self.EDGES = {c: np.linspace(lo, hi, bins + 1) if hi > lo else np.linspace(lo - 0.5, lo + 0.5, bins + 1) \
+            for c, (lo, hi) in ranges.items()} # Centred on a constant column's value
+        self.hists = {p: np.zeros((len(samples), bins), dtype = np.int64) for p, _ in REPORT_PARAMS}
+        self.grids = {(x, y): np.zeros((bins, bins), dtype = np.int64) for x, y, _, _ in REPORT_PAIRS}
+        self.sums = {(x, y): np.zeros(6) for x, y, _, _ in REPORT_PAIRS} # n, x, y, x^2, y^2, xy
+        self.counts = {c: np.zeros((len(samples), len(v)), dtype = np.int64) for c, v in REPORT_CATEGORIES.items()}
+        self.class_stats = {s: [0, 0, 0, set()] for s in samples} # MAGs, classified, species-level, species
+
+    @staticmethod
+    def scan(chunks):
+        '''The samples (in order) and each numeric column's (min, max) over all chunks.'''
+        samples = []
+        ranges = {}
+        for df in chunks:
+            samples += [s for s in df['sample'].unique() if s not in samples]
+            for c in REPORT_COLS:
+                if c in REPORT_CATEGORIES or c == 'classification' or df[c].isna().all():
+                    continue
+                lo, hi = ranges.get(c, (df[c].min(), df[c].max()))
+                ranges[c] = (min(lo, df[c].min()), max(hi, df[c].max()))
+        return samples, {c: ranges.get(c, (0, 1)) for c in REPORT_COLS if c not in REPORT_CATEGORIES and c != 'classification'}
+
+    def add(self, df):
+        import numpy as np
+        for s, grp in df.groupby('sample', sort = False):
+            i = self.SAMPLES.index(s)
+            for p, _ in REPORT_PARAMS:
+                self.hists[p][i] += np.histogram(grp[p].dropna(), bins = self.EDGES[p])[0]
+            for c, cats in REPORT_CATEGORIES.items():
+                vc = grp[c].value_counts()
+                self.counts[c][i] += [int(vc.get(v, 0)) for v in cats]
+            species = grp['species'][grp['species'] != '']
+            st = self.class_stats[s]
+            st[0] += len(grp)
+            st[1] += int(grp['classification'].notna().sum())
+            st[2] += len(species)
+            st[3].update(species)
+        sp = df[df['species'] != ''] # Only MAGs classified to species have reference-based statistics to compare
+        for x, y, _, _ in REPORT_PAIRS:
+            xy = sp[[x, y]].dropna()
+            if xy.empty:
+                continue
+            vx, vy = xy[x].to_numpy(dtype = float), xy[y].to_numpy(dtype = float)
+            self.grids[(x, y)] += np.histogram2d(vx, vy, bins = [self.EDGES[x], self.EDGES[y]])[0].astype(np.int64)
+            self.sums[(x, y)] += [len(vx), vx.sum(), vy.sum(), (vx * vx).sum(), (vy * vy).sum(), (vx * vy).sum()]
+
+    def box_stats(self, p, i):
+        '''Quartiles and whiskers (the most extreme bins within 1.5 IQR of the box) of a sample's histogram.'''
+        import numpy as np
+        counts, edges = self.hists[p][i], self.EDGES[p]
+        cum = np.concatenate([[0], np.cumsum(counts)])
+        if cum[-1] == 0:
+            return None
+        q1, med, q3 = np.interp(np.array([0.25, 0.5, 0.75]) * cum[-1], cum, edges)
+        iqr = q3 - q1
+        lo, hi = edges[:-1][counts > 0], edges[1:][counts > 0]
+        lo, hi = lo[lo >= q1 - 1.5 * iqr], hi[hi <= q3 + 1.5 * iqr]
+        return {'q1': q1, 'med': med, 'q3': q3, 'whislo': min(lo.min(), q1) if len(lo) else q1, \
+            'whishi': max(hi.max(), q3) if len(hi) else q3, 'fliers': [], 'label': self.SAMPLES[i]}
+
+    def pearson(self, x, y):
+        '''Pearson's r and the least-squares line (slope, intercept) of a pair, from its running sums.'''
+        n, sx, sy, sxx, syy, sxy = self.sums[(x, y)]
+        vx, vy, cov = n * sxx - sx * sx, n * syy - sy * sy, n * sxy - sx * sy
+        if n < 2 or vx <= 0:
+            return float('nan'), None
+        slope = cov / vx
+        return (cov / math.sqrt(vx * vy) if vy > 0 else float('nan')), (slope, (sy - slope * sx) / n)
+
+    def plot_box(self, ax, p, label):
+        stats = [self.box_stats(p, i) for i in range(len(self.SAMPLES))]
+        pos = [i for i, st in enumerate(stats) if st]
+        if pos:
+            bp = ax.bxp([stats[i] for i in pos], positions = pos, showfliers = False, patch_artist = True)
+            for i, box in zip(pos, bp['boxes']):
+                box.set_facecolor(self.colour(i))
+        self.sample_axis(ax)
+        ax.set_ylabel(label, size = 16)
+
+    def plot_counts(self, ax, c):
+        cats = REPORT_CATEGORIES[c]
+        width = 0.8 / len(cats)
+        palette = {'Near_Complete': '#356924', 'High': '#488f31', 'Medium': '#f4bd6a', 'Low': '#de425b', 'NA': '#999999', \
+            'Pass': '#488f31', 'Fail': '#de425b'}
+        for j, v in enumerate(cats):
+            if self.counts[c][:, j].any():
+                ax.bar([i - 0.4 + width * (j + 0.5) for i in range(len(self.SAMPLES))], self.counts[c][:, j], width, \
+                    label = v, color = palette[v])
+        self.sample_axis(ax)
+        ax.set_ylabel('Num. MAGs', size = 16)
+        ax.legend(title = c)
+
+    def plot_density(self, ax, x, y, x_label, y_label):
+        import numpy as np
+        from matplotlib.colors import LogNorm
+        grid = self.grids[(x, y)]
+        if grid.any():
+            ax.pcolormesh(self.EDGES[x], self.EDGES[y], np.ma.masked_equal(grid.T, 0), norm = LogNorm(), cmap = 'viridis')
+        r, line = self.pearson(x, y)
+        if line:
+            ends = self.EDGES[x][[0, -1]]
+            ax.plot(ends, line[0] * ends + line[1], color = '#de425b')
+        ax.set_xlim(*self.EDGES[x][[0, -1]]) # Not the regression line's
+        ax.set_ylim(*self.EDGES[y][[0, -1]])
+        ax.text(0.8, 0.05, 'r = {}'.format(np.round(r, 2)), transform = ax.transAxes, size = 12)
+        ax.set_xlabel(x_label, size = 16)
+        ax.set_ylabel(y_label, size = 16)
+
+    def colour(self, i):
+        import matplotlib
+        return matplotlib.colormaps['tab10'](i % 10)
+
+    def sample_axis(self, ax):
+        ax.set_xticks(range(len(self.SAMPLES)))
+        ax.set_xticklabels(self.SAMPLES, rotation = 90 if len(self.SAMPLES) > 4 else 0, size = 10 if len(self.SAMPLES) < 20 else 6)
+        ax.set_xlim(-0.5, len(self.SAMPLES) - 0.5)
+
+    def save(self, out_dir, dpi = 300):
+        '''Draw the summary statistics, reference vs. proxy statistics, and MAG vs. reference coverage figures (as
+        PNGs), and write the number of (classified) MAGs and species of each sample.'''
+        import matplotlib
+        matplotlib.use('Agg') # Headless
+        import matplotlib.pyplot as plt
+        check_make(out_dir)
+        fig, axs = plt.subplots(5, 4, figsize = (24, 24))
+        for j, (p, label) in enumerate(REPORT_PARAMS[:-1]):
+            self.plot_box(axs[j // 4, j % 4], p, label)
+        self.plot_counts(axs[4, 1], 'MIMAG_Quality')
+        self.plot_counts(axs[4, 2], 'GUNC_Status')
+        self.plot_box(axs[4, 3], *REPORT_PARAMS[-1])
+        fig.savefig(join(out_dir, 'summary_statistics.png'), dpi = dpi, bbox_inches = 'tight')
+        plt.close(fig)
+        fig, axs = plt.subplots(2, 2, figsize = (12, 12))
+        for i, pair in enumerate(REPORT_PAIRS[:-1]):
+            self.plot_density(axs[i // 2, i % 2], *pair)
+        fig.savefig(join(out_dir, 'ref_vs_proxy_stats.png'), dpi = dpi, bbox_inches = 'tight')
+        plt.close(fig)
+        fig, ax = plt.subplots(figsize = (6, 6))
+        self.plot_density(ax, *REPORT_PAIRS[-1])
+        fig.savefig(join(out_dir, 'mag_ref_cov.png'), dpi = dpi, bbox_inches = 'tight')
+        plt.close(fig)
+        with open(join(out_dir, 'classification_stats.csv'), 'w') as f_out:
+            f_out.write('sample_name,num_mags,num_classified,num_species,num_unique_species\n')
+            for s in self.SAMPLES:
+                n, c, sp, uniq = self.class_stats[s]
+                f_out.write('{},{},{},{},{}\n'.format(s, n, c, sp, len(uniq)))
+
+
+def cohort_report(work_dir, out_dir, source = 'auto', bins = 256, dpi = 300, chunk_size = 100000):
+    '''Render the cohort's figures from binned summaries of its MAGs, in two passes over the summaries.'''
+    samples, ranges = Cohort_Report.scan(summary_chunks(work_dir, source, chunk_size))
+    report = Cohort_Report(samples, ranges, bins)
+    for df in summary_chunks(work_dir, source, chunk_size):
+        report.add(df)
+    report.save(out_dir, dpi)
+    return report
+
+
+# --- Job profiles --- #
+
+
+BENCH_COLS = ['s', 'max_rss', 'max_vms', 'io_in', 'io_out', 'mean_load', 'cpu_time']
+MAG_MBP_BUCKETS = [0, 1, 2, 4, 8, float('inf')]
+MAG_MBP_LABELS = ['<1', '1-2', '2-4', '4-8', '>=8']
+
+
+def bench_path(log_dir, rule, wildcards):
+    '''Benchmark file of one of a rule's jobs, as {rule}/{wildcard}={value}/.../{wildcard}={value}.tsv.'''
+    parts = ['{0}={{{0}}}'.format(w) for w in wildcards] if wildcards else ['all']
+    return join(log_dir, 'benchmarks', rule, *parts) + '.tsv'
+
+
+def read_benchmarks(log_dir):
+    '''Load each job's benchmark (the first repeat) with the rule and wildcards from its path.'''
+    jobs = []
+    bench_dir = join(log_dir, 'benchmarks')
+    for fi in sorted(glob.glob(join(bench_dir, '**', '*.tsv'), recursive = True)):
+        parts = os.path.relpath(fi, bench_dir)[:-len('.tsv')].split(os.sep)
+        with open(fi, 'r') as f_in:
+            rows = list(csv.DictReader(f_in, delimiter = '\t'))
+        if not rows:
+            continue
+        wc = dict(p.split('=', 1) for p in parts[1:] if '=' in p)
+        job = {'rule': parts[0], 'wildcards': ','.join('{}={}'.format(k, v) for k, v in wc.items())}
+        for c in BENCH_COLS: # Very short jobs have no memory or CPU readings ('-' or NA)
+            try:
+                job[c] = float(rows[0][c])
+            except (KeyError, ValueError):
+                job[c] = None
+        jobs.append((job, wc))
+    return jobs
+
+
+def fa_mbp(fa_lst):
+    return sum(getsize(f) for f in fa_lst if exists(f)) / 1e6
+
+
+def job_size(rule, wc, tmp, out):
+    '''Number of MAGs and their summed size (Mbp) that a job ran on, or None where it's unknown.'''
+    tool = wc.get('tool', re.sub(r'^(cohort_|merge_shards_|cache_merge_|cohort_demux_)', '', rule))
+    if 'bin_num' in wc:
+        return 1, fa_mbp([join(tmp, wc['sample'], wc['bin_num'] + '.fa')])
+    if 'acc' in wc:
+        grp = join(out, '4_dnadiff', 'ref_groups', wc['acc'] + '.tsv')
+        if not exists(grp):
+            return None, None
+        fas = [l.split('\t')[2] for l in open(grp, 'r') if l.strip()]
+        return len(fas), fa_mbp(fas)
+    # The MAG list that the job's input was, from the most to the least specific
+    if 'batch' in wc:
+        fas = glob.glob(join(tmp, 'cohort', tool, wc['batch'], '*.fa'))
+        return (len(fas), fa_mbp(fas)) if fas else (None, None)
+    if 'sample' not in wc:
+        return None, None
+    s = wc['sample']
+    if 'shard' in wc:
+        lst = join(tmp, 'shards', '{}.{}'.format(s, tool), wc['shard'] + '.out')
+    elif rule in RULE_RESOURCES and exists(join(tmp, 'cache', '{}.{}.miss'.format(s, tool))):
+        lst = join(tmp, 'cache', '{}.{}.miss'.format(s, tool))
+    else:
+        lst = join(tmp, s + '.out')
+    if not exists(lst):
+        return None, None
+    bins = [l.strip() for l in open(lst, 'r') if l.strip()]
+    return len(bins), fa_mbp([join(tmp, s, b + '.fa') for b in bins])
+
+
+def profile_jobs(work_dir, config):
+    '''Each finished job's benchmark, input size, and the threads and memory it would have been given.'''
+    import pandas as pd
+    tmp, out = join(work_dir, 'tmp'), join(work_dir, 'mag_qc')
+    sizing = Resource_Scaler(config)
+    rows = []
+    for job, wc in read_benchmarks(join(work_dir, 'logs')):
+        n, mbp = job_size(job['rule'], wc, tmp, out)
+        job['num_mags'] = n
+        job['mbp'] = mbp
+        # Per-MAG and reference-group rules scale with Mbp, and the sample-level tools with the number of MAGs
+        base = re.sub(r'^cohort_(?!batches|demux)|_group$', '', job['rule'])
+        if base in RULE_RESOURCES:
+            size = (mbp if 'bin_num' in wc or 'acc' in wc else n) or 0
+            job['req_threads'] = sizing.scale(base, 'threads', size)
+            job['req_mem_mb'] = sizing.scale(base, 'mem_mb', size)
+        else:
+            job['req_threads'] = job['req_mem_mb'] = None
+        rows.append(job)
+    df = pd.DataFrame(rows, columns = ['rule', 'wildcards', *BENCH_COLS, 'num_mags', 'mbp', 'req_threads', 'req_mem_mb'])
+    df = df.astype({c: float for c in BENCH_COLS + ['num_mags', 'mbp', 'req_threads', 'req_mem_mb']})
+    # CPU time per requested core-second, and peak memory per requested MB
+    df['cpu_use'] = df['cpu_time'] / (df['s'] * df['req_threads'])
+    df['mem_use'] = df['max_rss'] / df['req_mem_mb']
+    df['mag_mbp_bucket'] = pd.cut(df['mbp'] / df['num_mags'], MAG_MBP_BUCKETS, right = False, labels = MAG_MBP_LABELS)
+    return df.sort_values('s', ascending = False, ignore_index = True)
+
+
+def print_profile(df, top, min_use, f_out = sys.stdout):
+    '''Print the slowest jobs, breakdowns by rule and by MAG size, and the jobs that used little of what they asked for.'''
+    import pandas as pd
+    with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:.2f}'.format):
+        cols = ['rule', 'wildcards', 's', 'cpu_time', 'max_rss', 'num_mags', 'mbp', 'req_threads', 'req_mem_mb']
+        print('# Slowest {} of {} jobs ({:.1f} h of wall time in total)'.format(min(top, len(df)), len(df), \
+            df['s'].sum() / 3600), file = f_out)
+        print(df[cols].head(top).to_string(index = False), '\n', file = f_out)
+        agg = {'jobs': ('s', 'size'), 'total_s': ('s', 'sum'), 'mean_s': ('s', 'mean'), 'max_s': ('s', 'max'), \
+            'cpu_h': ('cpu_time', lambda x: x.sum() / 3600), 'max_rss': ('max_rss', 'max'), 'mags': ('num_mags', 'sum'), \
+            'cpu_use': ('cpu_use', 'median'), 'mem_use': ('mem_use', 'median')}
+        by_rule = df.groupby('rule').agg(**agg).sort_values('total_s', ascending = False)
+        by_rule['s_per_mag'] = by_rule['total_s'] / by_rule['mags']
+        print('# By rule', file = f_out)
+        print(by_rule.to_string(), '\n', file = f_out)
+        by_size = df.dropna(subset = ['mag_mbp_bucket']).groupby(['rule', 'mag_mbp_bucket'], observed = True).agg(**agg)
+        by_size['s_per_mag'] = by_size['total_s'] / by_size['mags']
+        print('# By rule and mean MAG size (Mbp)', file = f_out)
+        print(by_size.to_string(), '\n', file = f_out)
+        # Only flag requests that are worth shrinking (more than a core, or a GB)
+        flag = df[((df['cpu_use'] < min_use) & (df['req_threads'] > 1)) | ((df['mem_use'] < min_use) & (df['req_mem_mb'] > 1000))]
+        print('# {} jobs used less than {:.0%} of their requested threads or memory'.format(len(flag), min_use), file = f_out)
+        if len(flag):
+            print(flag[['rule', 'wildcards', 's', 'req_threads', 'cpu_use', 'req_mem_mb', 'max_rss', 'mem_use']] \
+                .to_string(index = False), file = f_out)
+
+
+# --- Runtime model --- #
+
+
+# The rules that each rule of a sample's chain waits on (without sharding, cohort batches, or batch_align)
+RULE_DEPS = {
+    'hash_mags': [],
+    'cache_lookup': ['hash_mags'],
+    'checkm2': ['cache_lookup'],
+    'checkm_sh': ['cache_lookup'],
+    'gunc': ['cache_lookup'],
+    'gtdbtk': ['cache_lookup'],
+    'cache_merge_checkm2': ['checkm2'],
+    'cache_merge_checkm_sh': ['checkm_sh'],
+    'cache_merge_gunc': ['gunc'],
+    'cache_merge_gtdbtk': ['gtdbtk'],
+    'index_mag_bam': [],
+    'calc_mag_ra': ['index_mag_bam'],
+    'get_mag_refs': ['cache_merge_gtdbtk'],
+    'stage_ref': ['get_mag_refs'],
+    'dnadiff': ['stage_ref'],
+    'parse_dnadiff': ['dnadiff'],
+    'aggregate_dnadiff': ['parse_dnadiff'],
+    'quast': ['stage_ref'],
+    'aggregate_quast': ['quast'],
+    'ctg_name_edit': [],
+    'prokka': ['ctg_name_edit'],
+    'summarize_gene_cts': ['prokka'],
+    'summarize_reports': ['cache_merge_checkm2', 'cache_merge_checkm_sh', 'cache_merge_gunc', 'cache_merge_gtdbtk', \
+        'calc_mag_ra', 'aggregate_dnadiff', 'aggregate_quast', 'summarize_gene_cts'],
+}
+PER_MAG_RULES = ['stage_ref', 'dnadiff', 'parse_dnadiff', 'quast', 'ctg_name_edit', 'prokka']
+
+
+class Runtime_Model:
+    '''Wall time (s) of a rule's job predicted from its number of MAGs and their summed size (Mbp).
+
+    Each rule is fitted by least squares to s = a + b * num_mags + c * mbp over the benchmarks of earlier runs,
+    dropping terms that don't vary or whose coefficient comes out negative. Rules without benchmarks take no time.
+    '''
+    FEATURES = [['num_mags', 'mbp'], ['mbp'], ['num_mags'], []]
+
+    def __init__(self, fi = None):
+        self.COEFS = {}
+        if fi and exists(fi):
+            with open(fi, 'r') as f_in:
+                self.COEFS = json.load(f_in)
+
+    def fit(self, df):
+        '''Fit each rule from profile_jobs' table (rule, num_mags, mbp, s).'''
+        import numpy as np
+        for rule, grp in df.dropna(subset = ['s']).groupby('rule'):
+            for feats in self.FEATURES:
+                sub = grp.dropna(subset = feats)
+                if len(sub) <= len(feats) or any(sub[c].nunique() < 2 for c in feats):
+                    continue
+                X = np.column_stack([np.ones(len(sub))] + [sub[c].to_numpy(dtype = float) for c in feats])
+                coef = np.linalg.lstsq(X, sub['s'].to_numpy(dtype = float), rcond = None)[0]
+                if (coef >= 0).all():
+                    self.COEFS[rule] = dict(zip(['intercept'] + feats, coef.tolist()))
+                    break
+        return self
+
+    def save(self, fo):
+        write_manifest(fo, self.COEFS)
+
+    def predict(self, rule, num_mags, mbp):
+        c = self.COEFS.get(rule)
+        if not c:
+            return 0
+        return c['intercept'] + c.get('num_mags', 0) * (num_mags or 0) + c.get('mbp', 0) * (mbp or 0)
+
+    def job_time(self, rule, num_mags, mbp):
+        '''Predicted time of one of the rule's jobs for a sample of num_mags MAGs and mbp Mbp.'''
+        if rule in PER_MAG_RULES:
+            return self.predict(rule, 1, mbp / num_mags if num_mags else 0)
+        return self.predict(rule, num_mags, mbp)
+
+    def critical_path(self, times):
+        '''Finish time of each rule of a sample's chain, given each rule's (longest) job time.'''
+        finish = {}
+        for rule in RULE_DEPS: # Listed after the rules they wait on
+            finish[rule] = max([finish[d] for d in RULE_DEPS[rule]], default = 0) + times.get(rule, 0)
+        return finish
+
+    def priorities(self, sample_sizes):
+        '''Rule priorities (0-100) by how long the chain from each rule to the end is for the largest sample.'''
+        if not self.COEFS or not sample_sizes:
+            return {rule: 0 for rule in RULE_DEPS}
+        num_mags, mbp = max(sample_sizes.values(), key = lambda x: x[1])
+        # Time from the start of each rule to the end of the chain (the rule's upward rank)
+        rank = {}
+        for rule in reversed(list(RULE_DEPS)):
+            after = [rank[r] for r in RULE_DEPS if rule in RULE_DEPS[r]]
+            rank[rule] = self.job_time(rule, num_mags, mbp) + max(after, default = 0)
+        top = max(rank.values())
+        return {rule: int(round(100 * r / top)) if top > 0 else 0 for rule, r in rank.items()}
+
+
+def sample_sizes(tmp):
+    '''Number of MAGs and summed size (Mbp) of each ingested sample, from the manifest.'''
+    man = read_manifest(tmp)
+    return {s: (len(e['bins']), sum(v[1] for v in e['bins'].values()) / 1e6) for s, e in man.get('samples', {}).items()}
+
+
+def print_plan(f, work_dir, model, cores, f_out = sys.stdout):
+    '''Predict the makespan of the jobs in Snakemake's dry run output from the runtime model.'''
+    tmp, out = join(work_dir, 'tmp'), join(work_dir, 'mag_qc')
+    times = {} # {sample: {rule: longest job}}
+    work = 0
+    unknown = set()
+    for j in parse_dry_run(f):
+        wc = dict(w.split('=', 1) for w in j['wildcards'].split(', ') if '=' in w)
+        n, mbp = job_size(j['rule'], wc, tmp, out)
+        t = model.predict(j['rule'], n, mbp)
+        if j['rule'] not in model.COEFS and j['rule'] != 'all':
+            unknown.add(j['rule'])
+        work += t * int(j['threads'] or 1)
+        if 'sample' in wc:
+            times.setdefault(wc['sample'], {})
+            times[wc['sample']][j['rule']] = max(times[wc['sample']].get(j['rule'], 0), t)
+    paths = {s: max(model.critical_path(t).values()) for s, t in times.items()}
+    longest = max(paths.values(), default = 0)
+    print('# Predicted makespan: {:.2f} h on {} cores (longest sample chain {:.2f} h, {:.2f} core-h of work)'.format( \
+        max(longest, work / cores) / 3600, cores, longest / 3600, work / 3600), file = f_out)
+    if unknown:
+        print('# No benchmarks (predicted as 0 s) for: ' + ', '.join(sorted(unknown)), file = f_out)
+    print('sample\tchain_h', file = f_out)
+    for s in sorted(paths, key = paths.get, reverse = True):
+        print('{}\t{:.2f}'.format(s, paths[s] / 3600), file = f_out)
+
+
+# --- Disk footprint --- #
+
+
+RETENTION = ('all', 'reports', 'compress') # Keep every intermediate file, only the reports the workflow reads, or gzip the rest
+# Intermediate files that the per-MAG tools write next to their reports, as {prefix}{suffix}
+MAG_INTERMEDIATES = {
+    'dnadiff': ['.delta', '.1delta', '.mdelta', '.1coords', '.mcoords', '.snps', '.qdiff', '.rdiff', '.unqry', '.unref'],
+    'prokka': ['.gff', '.gbk', '.faa', '.ffn', '.fna', '.fsa', '.sqn', '.tbl', '.err', '.log'],
+}
+# Tool reports that the workflow reads, which cleanup never removes
+REPORT_FILES = {'quality_report.tsv', 'report.tsv', 'report.csv', 'GUNC.progenomes_2.1.maxCSS_level.tsv'}
+
+
+def check_retention(retention):
+    if retention not in RETENTION:
+        raise ValueError('retention must be one of {}, not {}'.format(', '.join(RETENTION), retention))
+
+
+def trim_files(retention, prefix, tool):
+    '''Shell command that applies the retention tier to the intermediate files a per-MAG tool wrote with this prefix.'''
+    check_retention(retention)
+    fs = ' '.join(prefix + s for s in MAG_INTERMEDIATES[tool])
+    if retention == 'reports':
+        return 'rm -f ' + fs
+    if retention == 'compress':
+        return 'for f in {}; do if [ -f $f ]; then gzip -f $f; fi; done'.format(fs)
+    return 'true'
+
+
+def trim_dir(retention, out_dir, keep = ()):
+    '''Shell command that applies the retention tier to a tool's output directory, sparing the reports in keep.'''
+    check_retention(retention)
+    spare = ' '.join("! -name '{}'".format(k) for k in keep)
+    if retention == 'reports':
+        return 'find {0} -mindepth 1 ! -type d {1} -delete; find {0} -mindepth 1 -type d -empty -delete'.format(out_dir, spare)
+    if retention == 'compress':
+        return "find {} -type f {} ! -name '*.gz' -print0 | xargs -0 -r -P 4 gzip -f".format(out_dir, spare)
+    return 'true'
+
+
+def is_intermediate(stage, rel):
+    '''Whether a file (by its path relative to its stage directory) can be removed once the final reports are written.'''
+    parts = rel.split(os.sep)
+    name = parts[-1][:-3] if parts[-1].endswith('.gz') else parts[-1]
+    if stage in ['mag_qc/0_checkm2', 'mag_qc/1_checkm1', 'mag_qc/2_gunc', 'mag_qc/3_gtdbtk']:
+        return name not in REPORT_FILES # The tools' working files (ex. predicted proteins, alignments)
+    if stage == 'mag_qc/4_dnadiff':
+        return name.endswith('.ref.fa') or name.endswith('.qry.fa') or \
+            any(name.endswith(s) for s in MAG_INTERMEDIATES['dnadiff'])
+    if stage == 'mag_qc/5_quast': # Only each MAG's report, the samples' tables, and the groups' markers are read
+        return not ((len(parts) == 3 and name == 'report.tsv') or (len(parts) == 2 and name in ['report.csv', 'report.tsv']) \
+            or (len(parts) == 3 and parts[1] == 'parts') or name.endswith('.done'))
+    if stage == 'mag_qc/6_prokka':
+        return (len(parts) > 1 and parts[1] == 'bins') or any(name.endswith(s) for s in MAG_INTERMEDIATES['prokka'])
+    if stage in ['tmp/ref_store', 'tmp/shards', 'tmp/cohort']:
+        return True
+    return False
+
+
+def stage_of(work_dir, path):
+    '''Group files by workflow step (mag_qc/{step}), by tmp/ subdirectory (MAGs and BAMs are tmp/samples), or logs.'''
+    parts = os.path.relpath(path, work_dir).split(os.sep)
+    if parts[0] == 'tmp' and len(parts) > 1:
+        return 'tmp/' + parts[1] if parts[1] in ['ref_store', 'shards', 'cohort', 'cache', 'result_cache'] else 'tmp/samples'
+    return '/'.join(parts[:2]) if parts[0] == 'mag_qc' and len(parts) > 2 else parts[0]
+
+
+def scan_files(work_dir, top, samples = None):
+    '''Every file under top, as (path, stage, intermediate, (device, inode), disk usage, number of links).'''
+    rows = []
+
+    def add(path, st, is_link):
+        stage = stage_of(work_dir, path)
+        parts = os.path.relpath(path, join(work_dir, stage)).split(os.sep)
+        if stage == 'tmp/samples': # Only the decompressed copies of MAGs (see release_inflated)
+            inter = path.endswith('.fa') and not is_link
+        else:
+            inter = is_intermediate(stage, os.sep.join(parts))
+        if inter and samples: # Only the given samples' files
+            inter = any(p == s or p.startswith(s + '.') for p in parts[:-1] for s in samples)
+        rows.append((path, stage, inter, (st.st_dev, st.st_ino), st.st_blocks * 512, st.st_nlink))
+
+    if not os.path.isdir(top) or os.path.islink(top):
+        add(top, os.lstat(top), os.path.islink(top))
+        return rows
+    dirs = [top]
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks = False):
+                    dirs.append(e.path)
+                else:
+                    add(e.path, e.stat(follow_symlinks = False), e.is_symlink())
+    return rows
+
+
+def disk_usage(work_dir, samples = None, threads = 8):
+    '''Disk usage (counting hardlinked files once) and reclaimable space of each stage of the working directory.
+
+    A file's space is only reclaimable if all of its links in the working directory are intermediates, and it has no
+    links elsewhere (ex. a reference genome that's still in a shared store).'''
+    from concurrent.futures import ThreadPoolExecutor
+    import pandas as pd
+    tops = []
+    for d in ['mag_qc', 'tmp', 'logs']:
+        if exists(join(work_dir, d)):
+            tops += [e.path for e in os.scandir(join(work_dir, d))]
+    with ThreadPoolExecutor(max_workers = threads) as pool: # One walk per subdirectory
+        rows = [r for rs in pool.map(lambda d: scan_files(work_dir, d, samples), tops) for r in rs]
+    df = pd.DataFrame(rows, columns = ['path', 'stage', 'intermediate', 'inode', 'bytes', 'nlink'])
+    if df.empty:
+        return df, pd.DataFrame(columns = ['files', 'bytes', 'reclaimable', 'remove'])
+    links = df.groupby('inode')['intermediate'].agg(['sum', 'size'])
+    df['free'] = df['inode'].map((links['sum'] == links['size']).to_dict()) & (df['nlink'] <= df['inode'].map(links['size']))
+    first = ~df['inode'].duplicated()
+    by_stage = pd.DataFrame({
+        'files': df.groupby('stage').size(),
+        'bytes': df[first].groupby('stage')['bytes'].sum(),
+        'reclaimable': df[first & df['free']].groupby('stage')['bytes'].sum(),
+        'remove': df[df['intermediate']].groupby('stage').size(),
+    }).fillna(0).astype(int).sort_index()
+    return df, by_stage
+
+
+def fmt_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(n) < 1000 or unit == 'TB':
+            return '{:.1f} {}'.format(n, unit) if unit != 'B' else '{} B'.format(int(n))
+        n /= 1000
+
+
+def print_disk_usage(by_stage, f_out = sys.stdout):
+    '''Print each stage's number of files, disk usage, and the space that cleanup would reclaim from it.'''
+    print('{:<24}  {:>9}  {:>10}  {:>9}  {:>11}'.format('stage', 'files', 'size', 'to_remove', 'reclaimable'), file = f_out)
+    for stage, r in by_stage.iterrows():
+        print('{:<24}  {:>9}  {:>10}  {:>9}  {:>11}'.format(stage, r['files'], fmt_bytes(r['bytes']), r['remove'], \
+            fmt_bytes(r['reclaimable'])), file = f_out)
+    print('{:<24}  {:>9}  {:>10}  {:>9}  {:>11}'.format('total', by_stage['files'].sum(), fmt_bytes(by_stage['bytes'].sum()), \
+        by_stage['remove'].sum(), fmt_bytes(by_stage['reclaimable'].sum())), file = f_out)
+
+
+def cleanup_files(work_dir, samples = None, dry_run = False, threads = 8):
+    '''Remove the intermediate files (see is_intermediate) of a finished working directory in parallel, printing each
+    stage's disk usage before (and after) removal. Rules whose intermediates were removed re-run if they're needed again.'''
+    from concurrent.futures import ThreadPoolExecutor
+    df, by_stage = disk_usage(work_dir, samples, threads)
+    if df.empty:
+        return
+    print_disk_usage(by_stage)
+    if dry_run:
+        return
+    paths = df.loc[df['intermediate'], 'path'].tolist()
+    with ThreadPoolExecutor(max_workers = threads) as pool:
+        list(pool.map(os.remove, paths, chunksize = 256))
+    # Then the directories that were emptied, deepest first
+    for d in sorted({os.path.dirname(p) for p in paths}, key = lambda d: d.count(os.sep), reverse = True):
+        while os.path.relpath(d, work_dir).count(os.sep) >= 2 and exists(d) and not os.listdir(d): # Not the stages' own
+            os.rmdir(d)
+            d = os.path.dirname(d)
+    print('\nRemoved {} files ({}).\n'.format(len(paths), fmt_bytes(by_stage['reclaimable'].sum())))
+    print_disk_usage(disk_usage(work_dir, samples, threads)[1])